@@ -1,6 +1,5 @@
 # -*- encoding:utf-8 -*-
-from flask import abort, request, render_template, jsonify, Response, Flask, redirect
-from xml.dom.minidom import parseString
+from flask import abort, request, render_template, jsonify, Response, Flask, redirect, stream_with_context
 import time
 import os
 import sys
@@ -8,6 +7,9 @@ import requests
 import random
 import hashlib
 import configparser
+import queue
+import threading
+from collections import OrderedDict, deque
 from Klipper_server import (
     getAccessToken,
     get_wechat_jsapi_ticket,
@@ -16,13 +18,27 @@ from Klipper_server import (
     getPrintStatus,
     getSystemStatus,
     sendWxMSg,
+    queueWxMsg,
+    message_queue,
     get_current_print_image,
-    getPrintJobList
+    getPrintJobList,
+    printers,
+    default_printer,
+    get_printer,
+    getFleetStatus,
+    start_state_subscribers,
+    media_cache,
+    stage_timings,
+    camera_session,
+    get_device_ip,
+    run_parallel
 )
+from Klipper_storage import storage
 from multiprocessing import Process
 import string
 sys.path.append("weworkapi_python/callback_python3")
 from WXBizMsgCrypt import WXBizMsgCrypt
+from Klipper_message import parse_callback_message
 
 # 加载配置文件
 config = configparser.ConfigParser()
@@ -48,23 +64,261 @@ def douban():
         echo_str = signature2(request, 0)
         return echo_str
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        'printers': {printer.id: printer.stats() for printer in printers},
+        'media_cache': media_cache.stats(),
+        'stages': stage_timings.stats(),
+        'mjpeg_relay': mjpeg_relay.stats(),
+        'commands': command_queue.stats(),
+        'outbound': message_queue.stats(),
+        'callback_dedup': callback_dedup.stats(),
+        'storage': storage.stats(),
+    })
+
 @app.route('/camera', methods=['GET'])
 def camera():
     return render_template("webcam.html")
 
+# 透传给浏览器的缓存相关响应头
+SNAPSHOT_FORWARD_HEADERS = ('Cache-Control', 'ETag', 'Last-Modified', 'Expires', 'Content-Length')
+
+def _stream_upstream(response, chunk_size=16384):
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
 @app.route("/getSnapshot", methods=['GET', 'POST'])
 def getSnapshot():
+    if config.getboolean('camera', 'snapshot_proxy_cache', fallback=False):
+        # 多个页面同时刷新时共用缓存中的最新一帧
+        snapshot = get_current_print_image()
+        if snapshot is None:
+            return "获取快照失败", 502
+        return Response(snapshot.data, content_type=snapshot.content_type, headers={'Cache-Control': 'no-cache'})
     try:
         cache_bust = int(time.time() * 1000)
-        snapshot_url = f"{config.get('server', 'webcam_snapshot_url')}?action=snapshot&cacheBust={cache_bust}"
-        response = requests.get(snapshot_url, stream=True)
+        webcam_url = config.get('server', 'webcam_snapshot_url', fallback=f"http://{get_device_ip()}/webcam/")
+        snapshot_url = f"{webcam_url}?action=snapshot&cacheBust={cache_bust}"
+        response = camera_session.get(snapshot_url, stream=True, timeout=10)
+        headers = {k: response.headers[k] for k in SNAPSHOT_FORWARD_HEADERS if k in response.headers}
         return Response(
-            response.content,
-            content_type=response.headers["Content-Type"]
+            stream_with_context(_stream_upstream(response)),
+            status=response.status_code,
+            content_type=response.headers.get("Content-Type", "image/jpeg"),
+            headers=headers,
         )
     except Exception as e:
         return f"获取快照失败: {str(e)}", 500
 
+def _multipart_boundary(content_type):
+    """从 Content-Type 中取出 multipart 分隔符，返回正文中的分隔行"""
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            value = value.strip().strip('"')
+            return (value if value.startswith('--') else '--' + value).encode()
+    return None
+
+
+def _content_length(headers):
+    for line in bytes(headers).split(b'\r\n'):
+        key, _, value = line.partition(b':')
+        if key.strip().lower() == b'content-length':
+            try:
+                return int(value.strip())
+            except ValueError:
+                return None
+    return None
+
+
+class MjpegRelay:
+    """MJPEG 转发
+
+    只向打印机摄像头建立一条上游连接，把每一帧分发给所有观看者；
+    每个观看者有一个很小的缓冲队列，客户端太慢时丢弃旧帧，只保留最新画面。
+    上游不支持 MJPEG 时退化为按固定帧率抓取快照；上游断开后按指数退避重连。
+    """
+
+    def __init__(self, buffer_size=2, fallback_fps=2, max_frame_bytes=4 * 1024 * 1024, max_backoff=30):
+        self.buffer_size = buffer_size
+        self.fallback_fps = fallback_fps
+        self.max_frame_bytes = max_frame_bytes
+        self.max_backoff = max_backoff
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._frame_times = deque(maxlen=100)
+        self.upstream = None
+        self.frames = 0
+        self.dropped = 0
+
+    def stream_url(self):
+        return config.get('camera', 'stream_url', fallback=f"http://{get_device_ip()}/webcam/?action=stream")
+
+    def subscribe(self):
+        """新增一个观看者，返回其帧队列"""
+        client = queue.Queue(maxsize=self.buffer_size)
+        with self._lock:
+            self._clients.add(client)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mjpeg-relay", daemon=True)
+                self._thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def _has_viewers(self):
+        with self._lock:
+            return bool(self._clients)
+
+    def _publish(self, frame):
+        self.frames += 1
+        self._frame_times.append(time.time())
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            if client.full():
+                try:
+                    client.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+            try:
+                client.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+
+    def _split_frames(self, chunks, boundary):
+        """按 multipart 分隔符切分帧，有 Content-Length 时按长度读取正文
+
+        JPEG 内嵌的 EXIF/JFIF 缩略图也带有 EOI（FFD9）标记，不能按标记切分。
+        """
+        buffer = bytearray()
+        length = None
+        in_body = False
+        for chunk in chunks:
+            buffer += chunk
+            while True:
+                if not in_body:
+                    start = buffer.find(boundary)
+                    header_end = buffer.find(b'\r\n\r\n', start) if start != -1 else -1
+                    if header_end == -1:
+                        break
+                    length = _content_length(buffer[start + len(boundary):header_end])
+                    del buffer[:header_end + 4]
+                    in_body = True
+                if length is not None:
+                    if len(buffer) < length:
+                        break
+                    frame = bytes(buffer[:length])
+                    del buffer[:length]
+                else:
+                    end = buffer.find(boundary)
+                    if end == -1:
+                        break
+                    frame = bytes(buffer[:end]).rstrip(b'\r\n')
+                    del buffer[:end]
+                in_body = False
+                yield frame
+            if len(buffer) > self.max_frame_bytes:
+                # 上游数据异常，丢弃缓冲区并等待下一个分隔符重新同步
+                self.dropped += 1
+                del buffer[:-len(boundary)]
+                in_body = False
+
+    def _read_mjpeg(self):
+        response = camera_session.get(self.stream_url(), stream=True, timeout=10)
+        try:
+            content_type = response.headers.get('Content-Type', '')
+            boundary = _multipart_boundary(content_type)
+            if response.status_code != 200 or 'multipart' not in content_type or not boundary:
+                return False
+            self.upstream = 'mjpeg'
+            for frame in self._split_frames(response.iter_content(chunk_size=16384), boundary):
+                if not self._has_viewers():
+                    break
+                self._publish(frame)
+            return True
+        finally:
+            response.close()
+
+    def _poll_snapshots(self):
+        self.upstream = 'snapshot'
+        interval = 1.0 / self.fallback_fps
+        while self._has_viewers():
+            started = time.time()
+            snapshot = get_current_print_image(max_age=interval)
+            if snapshot:
+                self._publish(snapshot.data)
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def _run(self):
+        delay = 1
+        while True:
+            with self._lock:
+                # 在锁内退出，避免与新观看者的 subscribe 竞争
+                if not self._clients:
+                    self._thread = None
+                    self.upstream = None
+                    return
+            frames = self.frames
+            try:
+                if not self._read_mjpeg():
+                    self._poll_snapshots()
+            except Exception as e:
+                print(f"摄像头视频流中断: {e}")
+            if self.frames > frames:
+                # 本次连接收到过画面，重新从最短间隔开始退避
+                delay = 1
+            if self._has_viewers():
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def stats(self):
+        now = time.time()
+        recent = [t for t in self._frame_times if now - t <= 5]
+        with self._lock:
+            viewers = len(self._clients)
+        return {
+            'viewers': viewers,
+            'upstream': self.upstream,
+            'fps': round(len(recent) / 5, 1),
+            'frames': self.frames,
+            'dropped': self.dropped,
+        }
+
+mjpeg_relay = MjpegRelay(
+    buffer_size=config.getint('camera', 'relay_buffer', fallback=2),
+    fallback_fps=config.getint('camera', 'relay_fallback_fps', fallback=2),
+    max_frame_bytes=config.getint('camera', 'relay_max_frame_kb', fallback=4096) * 1024,
+    max_backoff=config.getint('camera', 'relay_max_backoff', fallback=30),
+)
+
+@app.route("/camera/stream", methods=['GET'])
+def cameraStream():
+    client = mjpeg_relay.subscribe()
+
+    def generate():
+        try:
+            while True:
+                try:
+                    frame = client.get(timeout=30)
+                except queue.Empty:
+                    break
+                yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                       + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n')
+        finally:
+            mjpeg_relay.unsubscribe(client)
+
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache'})
+
 def signature(request, i):
     msg_signature = request.args.get('msg_signature', '')
     timestamp = request.args.get('timestamp', '')
@@ -81,44 +335,222 @@ def signature2(request, i):
     msg_signature = request.args.get('msg_signature', '')
     timestamp = request.args.get('timestamp', '')
     nonce = request.args.get('nonce', '')
-    data = request.data.decode('utf-8')
-    ret, sMsg = qy_api[i].DecryptMsg(data, msg_signature, timestamp, nonce)
+    ret, sMsg = qy_api[i].DecryptMsgFast(request.data, msg_signature, timestamp, nonce)
     if ret != 0:
         print("ERR: DecryptMsg ret: " + str(ret))
         return "failed"
     else:
-        doc = parseString(sMsg)
-        collection = doc.documentElement
-        name_xml = collection.getElementsByTagName("FromUserName")
-        msg_xml = collection.getElementsByTagName("Content")
-        type_xml = collection.getElementsByTagName("MsgType")
-        pic_xml = collection.getElementsByTagName("PicUrl")
-        msg = ""
-        name = ""
-        msg_type = type_xml[0].childNodes[0].data
-        if msg_type == "text":
-            name = name_xml[0].childNodes[0].data
-            msg = msg_xml[0].childNodes[0].data
-            if msg == '系统状态':
-                sendWxMSg(name, getSystemStatus())
-            if msg == '打印状态' or msg == '打印进度':
-                msg = getPrintStatus()
-                sendWxMSg(name, getPrintStatus(), get_current_print_image())
-            if msg == '打印任务统计':
-                sendWxMSg(name, getPrintJobList())
-            if msg == '拍照':
-                sendWxMSg(name, '', get_current_print_image())
-            if msg in ['开灯', '关灯']:
-                action = 'on' if msg == '开灯' else 'off'
-                result = controlLight(action)
-                img = get_current_print_image() if any(x in result for x in ["成功", "开启", "关闭"]) else None
-                sendWxMSg(name, result, img)
-        elif msg_type == "image":
-            name = name_xml[0].childNodes[0].data
-            pic_url = pic_xml[0].childNodes[0].data
+        message = parse_callback_message(sMsg)
+        if callback_dedup.seen(message.dedup_key):
+            print("重复的回调消息，已忽略")
+            return 'ok'
+        if message.msg_type == "text":
+            if not command_queue.submit(message.from_user, message.content):
+                # 未处理的消息不能算作已处理，企业微信重试时还可以再次入队
+                callback_dedup.forget(message.dedup_key)
+                print(f"指令队列已满，丢弃指令: {message.content}")
         return 'ok'
 
+PRUNE_DEDUP_SQL = 'DELETE FROM callback_dedup WHERE seen_at < ?'
+INSERT_DEDUP_SQL = 'INSERT OR IGNORE INTO callback_dedup (msg_key, seen_at) VALUES (?, ?)'
+DELETE_DEDUP_SQL = 'DELETE FROM callback_dedup WHERE msg_key = ?'
+
+
+class CallbackDeduplicator:
+    """回调去重
+
+    企业微信在回调超时时会重复推送同一条消息，这里记录最近处理过的消息，
+    重复的回调直接应答而不再执行指令。内存中为带过期时间的 LRU，
+    可选持久化到数据库，重启后仍能识别重试。
+    """
+
+    def __init__(self, ttl=300, maxsize=1000, persist=False):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.persist = persist
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def _seen_in_db(self, key, now):
+        """写入数据库，已存在且未过期时返回 True"""
+        try:
+            storage.execute(PRUNE_DEDUP_SQL, (now - self.ttl,))
+            return storage.execute(INSERT_DEDUP_SQL, (key, now)) == 0
+        except Exception as e:
+            print(f"查询去重表错误: {e}")
+            return False
+
+    def seen(self, key):
+        """判断消息是否已处理过，未处理过则记录下来"""
+        if not key:
+            return False
+        now = int(time.time())
+        with self._lock:
+            while self._seen:
+                seen_at = next(iter(self._seen.values()))
+                if seen_at >= now - self.ttl and len(self._seen) < self.maxsize:
+                    break
+                self._seen.popitem(last=False)
+            duplicate = key in self._seen
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            if not duplicate and self.persist:
+                duplicate = self._seen_in_db(key, now)
+            if duplicate:
+                self.duplicates += 1
+            return duplicate
+
+    def forget(self, key):
+        """撤销 seen() 的记录，用于消息最终没有被处理的情况"""
+        if not key:
+            return
+        with self._lock:
+            self._seen.pop(key, None)
+            if self.persist:
+                try:
+                    storage.execute(DELETE_DEDUP_SQL, (key,))
+                except Exception as e:
+                    print(f"删除去重记录错误: {e}")
+
+    def stats(self):
+        return {
+            'tracked': len(self._seen),
+            'duplicates': self.duplicates,
+        }
+
+callback_dedup = CallbackDeduplicator(
+    ttl=config.getint('server', 'dedup_ttl', fallback=300),
+    maxsize=config.getint('server', 'dedup_size', fallback=1000),
+    persist=config.getboolean('server', 'dedup_persist', fallback=False),
+)
+
+# 可以指定打印机编号的指令，例如“打印状态 P3”
+PRINTER_COMMANDS = ('系统状态', '打印状态', '打印进度', '打印任务统计', '拍照', '开灯', '关灯')
+
+def parse_command(msg):
+    """拆分指令和打印机编号，返回 (指令, 打印机编号或 None)"""
+    parts = msg.split()
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    for printer in printers:
+        # 兼容不带空格的写法，例如“打印状态P3”
+        if msg.lower().endswith(printer.id.lower()) and msg[:-len(printer.id)] in PRINTER_COMMANDS:
+            return msg[:-len(printer.id)], printer.id
+    return msg, None
+
+def handle_command(name, msg):
+    """执行文本指令并回复"""
+    command, printer_id = parse_command(msg)
+    if command == '全部状态':
+        queueWxMsg(name, getFleetStatus())
+        return
+    if command not in PRINTER_COMMANDS:
+        return
+    printer = get_printer(printer_id) if printer_id else default_printer
+    if printer is None:
+        queueWxMsg(name, f"❌ 未找到打印机 {printer_id}，可用编号: {', '.join(p.id for p in printers)}")
+        return
+    if command == '系统状态':
+        queueWxMsg(name, getSystemStatus(printer))
+    if command == '打印状态' or command == '打印进度':
+        status_msg, img = run_parallel(lambda: getPrintStatus(printer), lambda: get_current_print_image(printer=printer))
+        queueWxMsg(name, status_msg, img)
+    if command == '打印任务统计':
+        queueWxMsg(name, getPrintJobList(printer))
+    if command == '拍照':
+        queueWxMsg(name, '', get_current_print_image(printer=printer))
+    if command in ['开灯', '关灯']:
+        action = 'on' if command == '开灯' else 'off'
+        result = controlLight(action, printer)
+        img = get_current_print_image(max_age=0, printer=printer) if any(x in result for x in ["成功", "开启", "关闭"]) else None
+        queueWxMsg(name, result, img)
+
+class CommandQueue:
+    """企业微信指令队列
+
+    回调只负责解密和入队并立即返回，指令由后台线程池执行并回复，
+    避免超过企业微信 5 秒回调时限导致重试。队列有上限，满了直接拒绝。
+    """
+
+    def __init__(self, handler, workers=4, maxsize=100):
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._accepted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._max_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        for n in range(workers):
+            threading.Thread(target=self._worker, name=f"command-worker-{n}", daemon=True).start()
+
+    def submit(self, *args):
+        """入队一条指令，队列已满时返回 False"""
+        try:
+            self.queue.put_nowait((time.time(), args))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._accepted += 1
+            self._max_depth = max(self._max_depth, self.queue.qsize())
+        return True
+
+    def _worker(self):
+        while True:
+            enqueued_at, args = self.queue.get()
+            waited = time.time() - enqueued_at
+            with self._lock:
+                self._busy += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            try:
+                self.handler(*args)
+                failed = False
+            except Exception as e:
+                print(f"执行指令失败: {e}")
+                failed = True
+            finally:
+                self.queue.task_done()
+            with self._lock:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._failed + self._busy
+            return {
+                'depth': self.queue.qsize(),
+                'max_depth': self._max_depth,
+                'capacity': self.queue.maxsize,
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'accepted': self._accepted,
+                'rejected': self._rejected,
+                'completed': self._completed,
+                'failed': self._failed,
+                'avg_wait_ms': round(self._total_wait / started * 1000, 1) if started else 0,
+                'max_wait_ms': round(self._max_wait * 1000, 1),
+            }
+
+command_queue = CommandQueue(
+    handle_command,
+    workers=config.getint('server', 'worker_count', fallback=4),
+    maxsize=config.getint('server', 'queue_size', fallback=100),
+)
+
 if __name__ == '__main__':
+    if config.getboolean('monitor', 'use_websocket', fallback=True):
+        start_state_subscribers(printers)
     app.run(
         host="0.0.0.0",
         port=config.getint('server', 'flask_port')
@@ -0,0 +1,104 @@
+# -*- encoding:utf-8 -*-
+"""企业微信回调消息解析
+
+解密后的 XML 只解析一次，直接得到 CallbackMessage。
+直接运行本文件可对比 minidom 与本解析器的耗时和内存分配：
+    python Klipper_message.py [次数]
+"""
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+# XML 节点名 -> CallbackMessage 属性名
+FIELDS = {
+    'ToUserName': 'to_user',
+    'FromUserName': 'from_user',
+    'CreateTime': 'create_time',
+    'MsgType': 'msg_type',
+    'Content': 'content',
+    'PicUrl': 'pic_url',
+    'MediaId': 'media_id',
+    'MsgId': 'msg_id',
+    'Event': 'event',
+    'EventKey': 'event_key',
+    'AgentID': 'agent_id',
+}
+
+
+class CallbackMessage:
+    """企业微信回调消息，缺失的字段为空字符串"""
+
+    __slots__ = tuple(FIELDS.values())
+
+    def __init__(self, **values):
+        for attr in self.__slots__:
+            setattr(self, attr, values.get(attr, ''))
+
+    @property
+    def dedup_key(self):
+        """去重键：优先使用 MsgId，事件消息没有 MsgId 时使用发送者+时间+事件"""
+        if self.msg_id:
+            return self.msg_id
+        return ":".join([self.from_user, self.create_time, self.event])
+
+    def __repr__(self):
+        return f"CallbackMessage(msg_type={self.msg_type!r}, from_user={self.from_user!r}, msg_id={self.msg_id!r})"
+
+
+def parse_callback_message(xml):
+    """解析解密后的回调 XML（str 或 bytes）"""
+    root = ET.fromstring(xml)
+    values = {}
+    for child in root:
+        attr = FIELDS.get(child.tag)
+        if attr:
+            values[attr] = (child.text or '').strip()
+    return CallbackMessage(**values)
+
+
+SAMPLE_MSG = """<xml><ToUserName><![CDATA[ww1436e0e65a779aee]]></ToUserName>
+<FromUserName><![CDATA[ZhangSan]]></FromUserName>
+<CreateTime>1348831860</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[打印状态]]></Content>
+<MsgId>1234567890123456</MsgId>
+<AgentID>1000002</AgentID>
+</xml>""".encode()
+
+
+def _parse_minidom(xml):
+    """原 signature2 中的解析方式"""
+    from xml.dom.minidom import parseString
+    collection = parseString(xml).documentElement
+    name_xml = collection.getElementsByTagName("FromUserName")
+    msg_xml = collection.getElementsByTagName("Content")
+    type_xml = collection.getElementsByTagName("MsgType")
+    collection.getElementsByTagName("PicUrl")
+    return type_xml[0].childNodes[0].data, name_xml[0].childNodes[0].data, msg_xml[0].childNodes[0].data
+
+
+def _parse_fast(xml):
+    msg = parse_callback_message(xml)
+    return msg.msg_type, msg.from_user, msg.content
+
+
+def _benchmark(name, func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func(SAMPLE_MSG)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(SAMPLE_MSG)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} {elapsed / count * 1e6:>8.1f} 微秒/次  峰值分配 {peak / 1024:>6.1f} KB/次")
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    assert _parse_minidom(SAMPLE_MSG) == _parse_fast(SAMPLE_MSG)
+    old_time, old_peak = _benchmark("minidom", _parse_minidom, count)
+    new_time, new_peak = _benchmark("etree", _parse_fast, count)
+    print(f"耗时减少 {1 - new_time / old_time:.0%}，内存分配减少 {1 - new_peak / old_peak:.0%}")
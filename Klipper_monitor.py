@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 import time
-from Klipper_server import PrinterMonitor, init_db
+from Klipper_server import FleetMonitor
+from Klipper_storage import storage
 
 
 def main():
-    init_db()
-    monitor = PrinterMonitor()
-    initial_status = monitor.get_printer_status()
-    if initial_status:
-        monitor.last_state = initial_status['print_stats']['state']
-        print(f"初始打印机状态: {monitor.last_state}")
+    storage.connect()
+    fleet = FleetMonitor()
+    for monitor in fleet.monitors:
+        initial_status = monitor.get_printer_status()
+        if initial_status:
+            monitor.last_state = initial_status['print_stats']['state']
+            print(f"{monitor.printer.label}初始打印机状态: {monitor.last_state}")
     print("🚀 打印机监控服务已启动，开始监控...")
-    monitor.monitor_loop()
+    fleet.run()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
-import sqlite3
 from sqlite3 import Error
 import base64
 from io import BytesIO
@@ -14,121 +15,397 @@ import random
 import hashlib
 import string
 import configparser
+import threading
+import copy
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from Klipper_storage import storage
 
 # 加载配置文件
 config = configparser.ConfigParser()
 config.read('config.conf', encoding='utf-8')
 corp_id = config.get("wechat", "corp_id")
 agent_id = config.get("wechat", "agent_id")
-DB_FILE = config.get('database', 'db_file')
 check_interval = config.get('monitor', 'check_interval')
 
-def get_device_ip():
-    name = int(config.get("made", "name"))
-    if name == 1:
-        from made import qidi
-        ip = qidi.get_device_url()
-    else:
-        ip = config.get("made", "ip")
-    return ip
+class DeviceResolver:
+    """打印机地址解析缓存
+
+    QIDI 打印机的地址需要查询本地数据库并请求云端 deviceList 接口，
+    这里把解析结果缓存在内存中，过期前在后台线程刷新；
+    只有缓存地址连接失败（invalidate）或缓存过期时才会回源到云端。
+    """
+
+    def __init__(self, brand, ip, ttl=600, refresh_ahead=60):
+        self.brand = brand
+        self.ip = ip
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self._address = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _resolve(self):
+        if self.brand == 1:
+            from made import qidi
+            return qidi.get_device_url(self.ip)
+        return self.ip
+
+    def _refresh(self):
+        try:
+            address = self._resolve()
+        except Exception as e:
+            print(f"解析打印机地址失败: {e}")
+            address = None
+        if address:
+            self._address = address
+            self._expires_at = time.time() + self.ttl
+        elif self._address:
+            # 云端不可用时继续使用旧地址，稍后重试
+            self._expires_at = time.time() + self.refresh_ahead
+        return self._address
+
+    def _refresh_in_background(self):
+        def worker():
+            try:
+                with self._lock:
+                    self._refresh()
+            finally:
+                self._refreshing = False
+
+        self._refreshing = True
+        threading.Thread(target=worker, daemon=True).start()
+
+    def get(self):
+        """获取打印机地址，优先使用内存缓存"""
+        now = time.time()
+        if self._address and now < self._expires_at:
+            if now >= self._expires_at - self.refresh_ahead and not self._refreshing:
+                self._refresh_in_background()
+            return self._address
+        with self._lock:
+            if self._address and time.time() < self._expires_at:
+                return self._address
+            return self._refresh()
+
+    def invalidate(self):
+        """缓存地址连接失败时调用，下次获取时重新解析"""
+        self._expires_at = 0
+
+
+def get_device_ip(printer=None):
+    return (printer or default_printer).resolver.get()
+
+
+# 各 Moonraker 接口的超时时间（单位：秒），未列出的使用默认超时
+MOONRAKER_TIMEOUTS = {
+    '/access/oneshot_token': 5,
+    '/printer/objects/query': 5,
+    '/printer/gcode/script': 30,
+    '/server/files/metadata': 10,
+    '/server/history/totals': 10,
+    '/machine/proc_stats': 5,
+    '/machine/system_info': 10,
+}
+
+
+class MoonrakerClient:
+    """Moonraker HTTP 客户端
+
+    所有 Moonraker 请求共用一个 requests.Session，
+    连接池保持长连接，避免每次查询都重新建立 TCP/TLS 连接。
+    """
+
+    def __init__(self, resolver, pool_size=4, retries=2, timeout=10, timeouts=None):
+        self.resolver = resolver
+        self.timeout = timeout
+        self.timeouts = dict(MOONRAKER_TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=1,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self._lock = threading.Lock()
+        self._requests_served = 0
+        self._requests_failed = 0
+
+    def base_url(self):
+        address = self.resolver.get()
+        if not address:
+            raise requests.exceptions.ConnectionError("无法解析打印机地址")
+        return f"http://{address}"
+
+    def request(self, method, path, **kwargs):
+        """发送请求并返回解析后的 JSON"""
+        kwargs.setdefault('timeout', self.timeouts.get(path.split('?')[0], self.timeout))
+        try:
+            response = self.session.request(method, self.base_url() + path, **kwargs)
+            result = response.json()
+        except requests.exceptions.ConnectionError:
+            # 缓存的地址可能已失效，下次重新解析
+            self.resolver.invalidate()
+            self._count(failed=True)
+            raise
+        except Exception:
+            self._count(failed=True)
+            raise
+        self._count()
+        return result
+
+    def get(self, path, params=None, **kwargs):
+        return self.request('GET', path, params=params, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request('POST', path, json=json, **kwargs)
+
+    def _count(self, failed=False):
+        with self._lock:
+            if failed:
+                self._requests_failed += 1
+            else:
+                self._requests_served += 1
+
+    def stats(self):
+        """连接池统计：已建立的连接数与已完成的请求数"""
+        connections_opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections_opened += pool.num_connections
+        return {
+            'connections_opened': connections_opened,
+            'requests_served': self._requests_served,
+            'requests_failed': self._requests_failed,
+        }
+
 
 
 
-def create_connection():
-    conn = None
+def get_cached_token():
+    """从数据库获取缓存的token"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        return conn
+        return storage.get_cached_token('wecom')
     except Error as e:
-        print(f"数据库连接错误: {e}")
-    return conn
+        print(f"查询缓存token错误: {e}")
+    return None
 
 
-def init_db():
-    """初始化数据库表"""
-    conn = create_connection()
-    if conn is not None:
+def save_token_to_db(token, expires_in):
+    """保存token到数据库，返回过期时间"""
+    expires_at = int(time.time()) + expires_in - 200
+    try:
+        storage.save_token('wecom', token, expires_at)
+    except Error as e:
+        print(f"保存token到数据库错误: {e}")
+    return expires_at
+
+
+class CachedValue:
+    """带过期时间的单值缓存
+
+    并发调用 get() 时只有一个线程执行 loader，其余线程等待并共用同一次结果；
+    loader 抛出异常时，等待中的线程共用同一个异常，不会逐个重试；
+    设置 error_ttl 后失败结果也会缓存一段时间，期间的调用直接抛出该异常。
+    max_age=0 时只接受在调用之后才开始的加载，正在进行的旧加载不会被复用。
+    """
+
+    def __init__(self, loader, ttl, error_ttl=0):
+        self.loader = loader
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self._value = None
+        self._started_at = None
+        self._loaded_at = None
+        self._error = None
+        self._failed_at = None
+        self._pending = None
+        self._pending_started_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def _is_fresh(self, now, max_age):
+        return self._loaded_at is not None and now - self._loaded_at < max_age
+
+    def get(self, max_age=None):
+        """获取缓存值，max_age 可覆盖默认的过期时间（单位：秒）"""
+        max_age = self.ttl if max_age is None else max_age
+        requested_at = time.monotonic()
+        if self._is_fresh(requested_at, max_age):
+            self.hits += 1
+            return self._value
+        with self._lock:
+            # 等锁期间其他线程在调用之后才开始的加载同样可以直接使用
+            if self._loaded_at is not None and (self._started_at >= requested_at or self._is_fresh(time.monotonic(), max_age)):
+                self.hits += 1
+                return self._value
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.error_ttl:
+                self.hits += 1
+                raise self._error
+            future = self._pending
+            if future is not None and (max_age > 0 or self._pending_started_at >= requested_at):
+                self.hits += 1
+                loading = False
+            else:
+                # max_age=0 时不复用调用之前就已开始的加载
+                loading = True
+                started_at = time.monotonic()
+                future = self._pending = Future()
+                self._pending_started_at = started_at
+        if not loading:
+            # 已有线程在加载，等待同一次结果或异常
+            return future.result()
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS token_cache (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    token TEXT NOT NULL,
-                    expires_at INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            conn.commit()
-        except Error as e:
-            print(f"初始化数据库错误: {e}")
-        finally:
-            conn.close()
+            value = self.loader()
+        except BaseException as e:
+            with self._lock:
+                if self._pending is future:
+                    self._pending = None
+                self._error = e
+                self._failed_at = time.monotonic()
+                self.failures += 1
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # 并发的新旧两次加载，只保留开始得更晚的结果
+            if self._started_at is None or started_at >= self._started_at:
+                self._value = value
+                self._started_at = started_at
+                self._loaded_at = time.monotonic()
+            self._failed_at = None
+            if self._pending is future:
+                self._pending = None
+            self.misses += 1
+        future.set_result(value)
+        return value
+
+    def invalidate(self):
+        self._started_at = None
+        self._loaded_at = None
+        self._failed_at = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'failures': self.failures}
+
+
+# access_token 失效/过期的错误码，遇到时强制刷新
+TOKEN_EXPIRED_ERRCODES = (40014, 42001)
+
+
+class AccessTokenManager:
+    """企业微信 access_token 管理
+
+    token 保存在内存中，同一时间只有一个线程去企业微信刷新，其余线程等待结果；
+    数据库只做持久化，供 Klipper_app 和 Klipper_monitor 两个进程共享。
+    """
+
+    def __init__(self, refresh_ahead=300):
+        self.refresh_ahead = refresh_ahead
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _is_fresh(self, stale=None):
+        return (self._token is not None and self._token != stale
+                and time.time() < self._expires_at - self.refresh_ahead)
+
+    def _load_from_db(self):
+        cached_token = get_cached_token()
+        if cached_token and time.time() < cached_token['expires_at']:
+            self._token = cached_token['token']
+            self._expires_at = cached_token['expires_at']
+
+    def _fetch(self):
+        url = 'https://qyapi.weixin.qq.com/cgi-bin/gettoken'
+        params = {'corpid': config.get("wechat", "corp_id"), 'corpsecret': config.get("wechat", "corp_secret")}
+        result = requests.get(url, params=params, timeout=10).json()
+        if result['errcode'] != 0:
+            raise Exception(f"获取 access_token 失败: {result['errmsg']}")
+        self._expires_at = save_token_to_db(result['access_token'], result['expires_in'])
+        self._token = result['access_token']
+        return self._token
+
+    def _refresh(self, stale=None):
+        """需持有锁调用"""
+        if self._is_fresh(stale):
+            return self._token
+        # 另一个进程可能已经刷新并写入数据库
+        self._load_from_db()
+        if self._is_fresh(stale):
+            return self._token
+        return self._fetch()
+
+    def _refresh_in_background(self):
+        def worker():
+            try:
+                with self._lock:
+                    self._refresh()
+            except Exception as e:
+                print(f"后台刷新 access_token 失败: {e}")
+            finally:
+                self._refreshing = False
 
+        self._refreshing = True
+        threading.Thread(target=worker, daemon=True).start()
 
-def get_cached_token():
-    """从数据库获取缓存的token"""
-    conn = create_connection()
-    if conn is not None:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT token, expires_at FROM token_cache 
-                ORDER BY created_at DESC LIMIT 1
-            ''')
-            row = cursor.fetchone()
-            if row:
-                return {'token': row[0], 'expires_at': row[1]}
-        except Error as e:
-            print(f"查询缓存token错误: {e}")
-        finally:
-            conn.close()
-    return None
+    def get(self):
+        """获取 access_token，临近过期时在后台提前刷新"""
+        token, expires_at = self._token, self._expires_at
+        now = time.time()
+        if token and now < expires_at:
+            if now >= expires_at - self.refresh_ahead and not self._refreshing:
+                self._refresh_in_background()
+            return token
+        with self._lock:
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            return self._refresh()
 
+    def invalidate(self, token):
+        """token 被企业微信拒绝（40014/42001）时强制刷新"""
+        with self._lock:
+            return self._refresh(stale=token)
 
-def save_token_to_db(token, expires_in):
-    """保存token到数据库"""
-    conn = create_connection()
-    if conn is not None:
-        try:
-            current_time = int(time.time())
-            expires_at = current_time + expires_in - 200
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO token_cache (token, expires_at)
-                VALUES (?, ?)
-            ''', (token, expires_at))
-            conn.commit()
-        except Error as e:
-            print(f"保存token到数据库错误: {e}")
-        finally:
-            conn.close()
+
+token_manager = AccessTokenManager(
+    refresh_ahead=config.getint("wechat", "token_refresh_ahead", fallback=300)
+)
 
 
 def getAccessToken():
-    """获取access_token，优先从缓存读取"""
-    init_db()
-    cached_token = get_cached_token()
-    current_time = int(time.time())
-    if cached_token and current_time < cached_token['expires_at']:
-        return cached_token['token']
-
-    url = f'https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid={config.get("wechat", "corp_id")}&corpsecret={config.get("wechat", "corp_secret")}'
-    print(url)
-    response = requests.get(url)
-    result = response.json()
-
-    if result['errcode'] == 0:
-        save_token_to_db(result['access_token'], result['expires_in'])
-        return result['access_token']
-    else:
-        raise Exception(f"获取 access_token 失败: {result['errmsg']}")
+    """获取access_token，优先从内存缓存读取"""
+    return token_manager.get()
+
+
+def wecom_request(method, path, **kwargs):
+    """调用企业微信接口，access_token 失效时刷新后重试一次"""
+    url = f"https://qyapi.weixin.qq.com/cgi-bin{path}"
+    params = dict(kwargs.pop('params', None) or {})
+    kwargs.setdefault('timeout', 10)
+    access_token = getAccessToken()
+    params['access_token'] = access_token
+    result = requests.request(method, url, params=params, **kwargs).json()
+    if result.get('errcode') in TOKEN_EXPIRED_ERRCODES:
+        params['access_token'] = token_manager.invalidate(access_token)
+        result = requests.request(method, url, params=params, **kwargs).json()
+    return result
+
 
 def get_wechat_jsapi_ticket():
     """获取JS-SDK ticket"""
-    access_token = getAccessToken()
-    url = f'https://qyapi.weixin.qq.com/cgi-bin/get_jsapi_ticket?access_token={access_token}'
-    response = requests.get(url)
-    return response.json().get('ticket', '')
+    return wecom_request('GET', '/get_jsapi_ticket').get('ticket', '')
 
 
 def generate_jsapi_config(url):
@@ -151,24 +428,199 @@ def generate_jsapi_config(url):
     }
 
 
-def get_current_print_image():
-    """获取当前打印的图片"""
+class Snapshot:
+    """摄像头快照，保存原始图片字节，上传前不再做 base64 编解码"""
+
+    __slots__ = ('data', 'content_type', 'captured_at')
+
+    def __init__(self, data, content_type='image/jpeg', captured_at=None):
+        self.data = data
+        self.content_type = content_type
+        self.captured_at = time.time() if captured_at is None else captured_at
+
+    @classmethod
+    def from_base64(cls, image_base64, content_type='image/jpeg'):
+        return cls(base64.b64decode(image_base64), content_type)
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def __len__(self):
+        return len(self.data)
+
+
+def as_snapshot(image):
+    """兼容旧调用方式：image 可以是 Snapshot、图片字节或 base64 字符串"""
+    if image is None or isinstance(image, Snapshot):
+        return image
+    if isinstance(image, str):
+        return Snapshot.from_base64(image)
+    if isinstance(image, memoryview):
+        return Snapshot(image.tobytes())
+    return Snapshot(bytes(image))
+
+
+class StageTimings:
+    """各处理阶段的耗时统计（抓取、压缩、上传）"""
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['last'] = seconds
+
+    def timed(self, stage, func, *args, **kwargs):
+        """执行 func 并记录耗时"""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {
+                    'count': entry['count'],
+                    'avg_ms': round(entry['total'] / entry['count'] * 1000, 1),
+                    'max_ms': round(entry['max'] * 1000, 1),
+                    'last_ms': round(entry['last'] * 1000, 1),
+                }
+                for stage, entry in self._stages.items()
+            }
+
+
+stage_timings = StageTimings()
+
+# 图片处理在独立线程池中执行
+image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image")
+
+IMAGE_PROCESS = config.getboolean("camera", "process_image", fallback=True)
+IMAGE_MAX_DIMENSION = config.getint("camera", "max_dimension", fallback=1280)
+IMAGE_QUALITY = config.getint("camera", "jpeg_quality", fallback=80)
+IMAGE_MAX_BYTES = config.getint("camera", "max_kb", fallback=0) * 1024
+IMAGE_STRIP_EXIF = config.getboolean("camera", "strip_exif", fallback=True)
+
+
+def process_snapshot(snapshot):
+    """缩放并重新压缩图片
+
+    长边超过 max_dimension 时等比缩小，按 jpeg_quality 重新编码；
+    设置了 max_kb 时逐步降低质量直到满足大小限制。
+    """
+    image = Image.open(BytesIO(snapshot.data))
+    image.load()
+    resized = max(image.size) > IMAGE_MAX_DIMENSION
+    if resized:
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    has_exif = bool(image.info.get('exif'))
+    exif = None if IMAGE_STRIP_EXIF else image.info.get('exif')
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    quality = IMAGE_QUALITY
+    while True:
+        buffer = BytesIO()
+        options = {'format': 'JPEG', 'quality': quality, 'optimize': True}
+        if exif:
+            options['exif'] = exif
+        image.save(buffer, **options)
+        data = buffer.getvalue()
+        if not IMAGE_MAX_BYTES or len(data) <= IMAGE_MAX_BYTES or quality <= 30:
+            break
+        quality -= 10
+
+    # 未缩放且重新编码后反而更大时保留原图；需要去除的 EXIF 只有重新编码才能去掉
+    keep_original = not (IMAGE_STRIP_EXIF and has_exif)
+    if keep_original and not resized and len(data) >= len(snapshot.data) and snapshot.content_type == 'image/jpeg' and not IMAGE_MAX_BYTES:
+        return snapshot
+    return Snapshot(data, 'image/jpeg', snapshot.captured_at)
+
+
+# 摄像头请求共用连接池
+camera_session = requests.Session()
+camera_session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=8))
+camera_session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+
+def _download_snapshot(printer):
+    WEBCAM_SNAPSHOT_URL = f'http://{printer.resolver.get()}/webcam/snapshot'
     try:
-        WEBCAM_SNAPSHOT_URL = f'http://{get_device_ip()}/webcam/snapshot'
-        response = requests.get(WEBCAM_SNAPSHOT_URL, timeout=10)
-        if response.status_code == 200:
-            img_base64 = base64.b64encode(response.content).decode('utf-8')
-            return img_base64
-        else:
-            return None
+        response = camera_session.get(WEBCAM_SNAPSHOT_URL, timeout=10)
+    except requests.exceptions.ConnectionError:
+        printer.resolver.invalidate()
+        raise
+    if response.status_code != 200:
+        raise Exception(f"摄像头返回 {response.status_code}")
+    content_type = response.headers.get('Content-Type', 'image/jpeg')
+    return Snapshot(response.content, content_type)
+
+
+def _capture_snapshot(printer):
+    """从摄像头抓取一帧并压缩"""
+    snapshot = stage_timings.timed('capture', _download_snapshot, printer)
+    if not IMAGE_PROCESS:
+        return snapshot
+    try:
+        future = image_executor.submit(stage_timings.timed, 'process', process_snapshot, snapshot)
+        return future.result()
+    except Exception as e:
+        print(f"图片压缩失败，使用原图: {e}")
+        return snapshot
+
+
+def get_current_print_image(max_age=None, printer=None):
+    """获取当前打印的图片，返回 Snapshot
+
+    max_age 为可接受的帧龄（单位：秒），默认使用 snapshot_fresh_ms；
+    传 0 表示需要在调用之后抓取的新帧（例如开关灯之后）。
+    """
+    try:
+        return (printer or default_printer).frame_cache.get(max_age)
     except Exception as e:
         print(f"获取打印图片失败: {e}")
         return None
 
 
+# 并发查询线程池，互不依赖的请求同时发出
+query_executor = ThreadPoolExecutor(
+    max_workers=config.getint("made", "query_workers", fallback=8),
+    thread_name_prefix="query",
+)
+
+
+def run_parallel(*funcs):
+    """并发执行多个无参函数，按顺序返回结果，任一函数出错时抛出异常"""
+    if len(funcs) < 2 or threading.current_thread().name.startswith("query"):
+        # 已在查询线程中时顺序执行，避免线程池嵌套等待导致死锁
+        return [func() for func in funcs]
+    futures = [query_executor.submit(func) for func in funcs[1:]]
+    first = funcs[0]()
+    return [first] + [future.result() for future in futures]
+
+
+# 打印状态查询的对象，指令回复和打印监控共用一份
+PRINTER_OBJECTS = ('print_stats', 'virtual_sdcard', 'toolhead', 'extruder', 'heater_bed', 'gcode_move', 'display_status')
+
+
+def _query_printer_objects(client):
+    printer_data = client.get("/printer/objects/query?" + "&".join(PRINTER_OBJECTS))
+    return printer_data['result']['status']
+
+
+def get_printer_objects(max_age=None, printer=None):
+    """获取打印机状态快照，短时间内的多次查询只请求一次 Moonraker"""
+    return (printer or default_printer).status_cache.get(max_age)
+
+
 async def getPrintStatusWs(max_messages=10):
-    url = f'http://{get_device_ip()}/access/oneshot_token'
-    res = requests.get(url).json()
+    res = default_printer.client.get('/access/oneshot_token')
     token = res['result']
     ws_url = f'ws://{get_device_ip()}/websocket?token={token}'
     try:
@@ -207,6 +659,236 @@ async def getPrintStatusWs(max_messages=10):
         return f"❌ WS 获取打印机状态失败: {str(e)}"
 
 
+# websocket 订阅的打印机对象，None 表示订阅全部字段
+SUBSCRIBE_OBJECTS = {
+    "print_stats": None,
+    "virtual_sdcard": None,
+    "toolhead": None,
+    "extruder": None,
+    "heater_bed": None,
+    "gcode_move": None,
+    "display_status": None,
+    "heater_generic chamber": None,
+}
+
+
+def merge_status(target, delta):
+    """把 notify_status_update 的增量合并到完整状态中"""
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_status(target[key], value)
+        else:
+            target[key] = value
+
+
+class PrinterState:
+    """打印机状态模型
+
+    合并 websocket 推送的增量，维护各打印机对象的完整状态，
+    字段缺失时用默认值补齐；每次更新 version 加一。
+    """
+
+    DEFAULTS = {
+        'print_stats': {'state': 'unknown', 'filename': '', 'print_duration': 0, 'total_duration': 0,
+                        'filament_used': 0, 'message': '', 'info': {'current_layer': 0, 'total_layer': 0}},
+        'virtual_sdcard': {'progress': 0, 'is_active': False, 'file_position': 0},
+        'toolhead': {'position': [0, 0, 0, 0], 'homed_axes': '', 'print_time': 0},
+        'extruder': {'temperature': 0, 'target': 0, 'power': 0},
+        'heater_bed': {'temperature': 0, 'target': 0, 'power': 0},
+        'gcode_move': {'speed_factor': 1, 'extrude_factor': 1},
+        'display_status': {'progress': 0, 'message': None},
+        'heater_generic chamber': {'temperature': 0, 'target': 0, 'power': 0},
+    }
+
+    def __init__(self):
+        self._status = {}
+        self._proc_stats = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self.updated_at = 0
+        self.connected = False
+
+    def replace(self, status):
+        """订阅应答中的完整状态"""
+        with self._lock:
+            self._status = status
+            self._touch()
+
+    def apply(self, delta):
+        """合并 notify_status_update 增量"""
+        with self._lock:
+            merge_status(self._status, delta)
+            self._touch()
+
+    def update_proc_stats(self, proc_stats):
+        """合并 notify_proc_stat_update 推送的系统信息"""
+        with self._lock:
+            self._proc_stats = dict(self._proc_stats or {}, **proc_stats)
+
+    def _touch(self):
+        self.version += 1
+        self.updated_at = time.time()
+
+    def _get(self, name):
+        value = copy.deepcopy(self.DEFAULTS.get(name, {}))
+        merge_status(value, self._status.get(name) or {})
+        return value
+
+    def snapshot(self):
+        """完整状态的副本，格式与 /printer/objects/query 返回的 status 相同"""
+        with self._lock:
+            return {name: self._get(name) for name in set(self.DEFAULTS) | set(self._status)}
+
+    def proc_stats(self):
+        with self._lock:
+            return copy.deepcopy(self._proc_stats)
+
+    def is_live(self):
+        """websocket 已连接且收到过打印机状态"""
+        return self.connected and 'print_stats' in self._status
+
+    @property
+    def print_stats(self):
+        with self._lock:
+            return self._get('print_stats')
+
+    @property
+    def virtual_sdcard(self):
+        with self._lock:
+            return self._get('virtual_sdcard')
+
+    @property
+    def toolhead(self):
+        with self._lock:
+            return self._get('toolhead')
+
+    @property
+    def extruder(self):
+        with self._lock:
+            return self._get('extruder')
+
+    @property
+    def heater_bed(self):
+        with self._lock:
+            return self._get('heater_bed')
+
+    @property
+    def display_status(self):
+        with self._lock:
+            return self._get('display_status')
+
+    @property
+    def chamber(self):
+        with self._lock:
+            return self._get('heater_generic chamber')
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'version': self.version,
+            'age': round(time.time() - self.updated_at, 1) if self.updated_at else None,
+        }
+
+
+class MoonrakerSubscriber:
+    """Moonraker websocket 订阅
+
+    保持一个长连接订阅打印机对象，把 notify_status_update 增量合并到 PrinterState，
+    每次更新后调用监听函数；断线后按指数退避重连。
+    """
+
+    def __init__(self, printer, objects=None, min_backoff=1, max_backoff=60):
+        self.printer = printer
+        self.client = printer.client
+        self.state = printer.state
+        self.objects = objects or SUBSCRIBE_OBJECTS
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.listeners = []
+        self._subscribe_id = 0
+
+    def add_listener(self, listener):
+        """注册状态更新回调 listener(state)"""
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            try:
+                listener(self.state)
+            except Exception as e:
+                print(f"状态监听回调错误: {e}")
+
+    async def _subscribe(self, websocket):
+        self._subscribe_id += 1
+        await websocket.send(json.dumps({
+            "jsonrpc": "2.0",
+            "method": "printer.objects.subscribe",
+            "params": {"objects": self.objects},
+            "id": self._subscribe_id,
+        }))
+
+    def _handle_message(self, data):
+        method = data.get('method')
+        if data.get('id') == self._subscribe_id and 'result' in data:
+            # 订阅应答包含完整状态
+            self.state.replace(data['result']['status'])
+            self.state.connected = True
+            self.printer.metadata_cache.observe(self.state.print_stats)
+            self._notify()
+        elif method == 'notify_status_update':
+            self.state.apply(data['params'][0])
+            self.printer.metadata_cache.observe(self.state.print_stats)
+            self._notify()
+        elif method == 'notify_proc_stat_update':
+            self.state.update_proc_stats(data['params'][0])
+        elif method in ('notify_klippy_disconnected', 'notify_klippy_shutdown'):
+            self.state.connected = False
+        elif method == 'notify_filelist_changed':
+            self.printer.metadata_cache.handle_filelist_changed(data['params'])
+
+    async def _session(self):
+        token = (await asyncio.to_thread(self.client.get, '/access/oneshot_token'))['result']
+        # 缓存过期时解析地址可能请求 QIDI 云端，不能阻塞共用的事件循环
+        address = await asyncio.to_thread(self.client.resolver.get)
+        ws_url = f"ws://{address}/websocket?token={token}"
+        async with websockets.connect(ws_url, ping_interval=20, ping_timeout=20, max_size=None) as websocket:
+            await self._subscribe(websocket)
+            async for message in websocket:
+                data = json.loads(message)
+                if data.get('method') == 'notify_klippy_ready':
+                    # Klipper 重启后需要重新订阅
+                    await self._subscribe(websocket)
+                    continue
+                self._handle_message(data)
+
+    async def run(self):
+        """保持订阅，断线后重连"""
+        backoff = self.min_backoff
+        while True:
+            try:
+                await self._session()
+            except Exception as e:
+                print(f"{self.printer.label}websocket 连接断开: {e}")
+                if isinstance(e, OSError):
+                    self.client.resolver.invalidate()
+            if self.state.connected:
+                backoff = self.min_backoff
+            self.state.connected = False
+            await asyncio.sleep(backoff * random.uniform(0.8, 1.2))
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+def start_state_subscribers(printer_list=None):
+    """在一个后台线程的事件循环中运行所有打印机的 websocket 订阅，保持各自的 PrinterState 为最新状态"""
+    subscribers = [MoonrakerSubscriber(printer) for printer in (printer_list or printers)]
+
+    async def run_all():
+        await asyncio.gather(*(subscriber.run() for subscriber in subscribers))
+
+    threading.Thread(target=asyncio.run, args=(run_all(),), name="moonraker-subscriber", daemon=True).start()
+    return subscribers
+
+
 def calculatePrintTime(print_duration,display_progress):
     progress = display_progress
     if progress > 0:
@@ -220,80 +902,287 @@ def calculatePrintTime(print_duration,display_progress):
     return f"{h}h {m}m {s}s"
 
 
-def calculatePrintTime2(filename,print_duration):
-    url = f'http://{get_device_ip()}/server/files/metadata?filename={filename}'
-    estimated_time = requests.get(url).json()['result']['estimated_time']
-    total_time = estimated_time - print_duration
+class GcodeMetadataCache:
+    """gcode 文件元数据缓存
+
+    打印过程中文件的 estimated_time 等信息不会变化，按文件名缓存，并用 Moonraker
+    返回的 modified/size 校验；超出容量时淘汰最久未使用的文件。
+    文件变化（notify_filelist_changed）或文件进入打印状态时失效。
+    """
+
+    def __init__(self, client, maxsize=32):
+        self.client = client
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._printing = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _matches(metadata, modified, size):
+        return ((modified is None or metadata.get('modified') == modified)
+                and (size is None or metadata.get('size') == size))
+
+    def get(self, filename, modified=None, size=None):
+        """获取文件元数据，modified 或 size 与缓存不一致时重新请求"""
+        with self._lock:
+            metadata = self._entries.get(filename)
+            if metadata is not None and self._matches(metadata, modified, size):
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return metadata
+        metadata = self.client.get('/server/files/metadata', params={'filename': filename})['result']
+        with self._lock:
+            self.misses += 1
+            self._entries[filename] = metadata
+            self._entries.move_to_end(filename)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return metadata
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(filename, None)
+
+    def get_for_status(self, status):
+        """获取状态中当前文件的元数据
+
+        状态对象里没有文件的修改时间，用 virtual_sdcard 的 file_size 校验缓存，
+        同名文件重新上传后大小变化即重新请求。
+        """
+        file_size = (status.get('virtual_sdcard') or {}).get('file_size') or None
+        return self.get(status['print_stats']['filename'], size=file_size)
+
+    def observe(self, print_stats):
+        """文件进入打印状态时失效缓存，打印期间 Moonraker 不允许覆盖正在打印的文件"""
+        filename = print_stats.get('filename')
+        active = filename if print_stats.get('state') in ('printing', 'paused') else None
+        with self._lock:
+            started = active is not None and active != self._printing
+            self._printing = active
+            if started:
+                self._entries.pop(filename, None)
+
+    def handle_filelist_changed(self, params):
+        """处理 Moonraker 的 notify_filelist_changed 通知"""
+        for change in params:
+            for key in ('item', 'source_item'):
+                item = change.get(key) or {}
+                if item.get('root', 'gcodes') == 'gcodes' and item.get('path'):
+                    self.invalidate(item['path'])
+
+    def stats(self):
+        return {'files': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class Printer:
+    """一台打印机：地址解析、Moonraker 连接、状态模型和各类缓存"""
+
+    def __init__(self, printer_id, brand, ip):
+        self.id = printer_id
+        self.resolver = DeviceResolver(
+            brand,
+            ip,
+            ttl=config.getint("made", "resolve_ttl", fallback=600),
+            refresh_ahead=config.getint("made", "resolve_refresh_ahead", fallback=60),
+        )
+        self.client = MoonrakerClient(
+            self.resolver,
+            pool_size=config.getint("made", "pool_size", fallback=4),
+            retries=config.getint("made", "retries", fallback=2),
+            timeout=config.getint("made", "timeout", fallback=10),
+        )
+        self.state = PrinterState()
+        self.status_cache = CachedValue(
+            self._query_status,
+            ttl=config.getfloat("monitor", "status_cache_ttl", fallback=2),
+        )
+        self.metadata_cache = GcodeMetadataCache(
+            self.client,
+            maxsize=config.getint("monitor", "metadata_cache_size", fallback=32),
+        )
+        # 系统信息（网卡、系统版本等）很少变化，缓存数分钟
+        self.system_info_cache = CachedValue(
+            lambda: self.client.get("/machine/system_info")['result'],
+            ttl=config.getint("monitor", "system_info_cache_ttl", fallback=300),
+        )
+        # 摄像头帧缓存：新鲜度窗口内直接返回内存中的帧，并发请求共用同一次抓取
+        self.frame_cache = CachedValue(
+            lambda: _capture_snapshot(self),
+            ttl=config.getint("camera", "snapshot_fresh_ms", fallback=1000) / 1000,
+            # 摄像头离线时，排队的指令不再逐个等待抓取超时
+            error_ttl=config.getint("camera", "snapshot_error_ttl", fallback=10),
+        )
+
+    def _query_status(self):
+        status = _query_printer_objects(self.client)
+        self.metadata_cache.observe(status['print_stats'])
+        return status
+
+    @property
+    def label(self):
+        """多台打印机时消息前加上打印机编号"""
+        return f"[{self.id}] " if len(printers) > 1 else ""
+
+    def stats(self):
+        return {
+            'moonraker': self.client.stats(),
+            'status_cache': self.status_cache.stats(),
+            'metadata_cache': self.metadata_cache.stats(),
+            'frame_cache': self.frame_cache.stats(),
+            'printer_state': self.state.stats(),
+        }
+
+
+def load_printers():
+    """读取打印机列表：[made] 为第一台，其余为 [printer 编号] 配置段"""
+    result = [Printer(
+        config.get("made", "printer_id", fallback="P1"),
+        int(config.get("made", "name")),
+        config.get("made", "ip"),
+    )]
+    for section in config.sections():
+        if section.startswith("printer "):
+            result.append(Printer(
+                section[len("printer "):].strip(),
+                config.getint(section, "name", fallback=2),
+                config.get(section, "ip"),
+            ))
+    return result
+
+
+printers = load_printers()
+default_printer = printers[0]
+
+
+# 同时查询所有打印机的线程池，每台打印机一个线程
+fleet_executor = ThreadPoolExecutor(max_workers=len(printers), thread_name_prefix="query-fleet")
+
+
+def get_printer(printer_id):
+    """按编号查找打印机（不区分大小写），找不到返回 None"""
+    for printer in printers:
+        if printer.id.lower() == printer_id.lower():
+            return printer
+    return None
+
+
+def format_gcode_info(metadata):
+    """格式化切片信息"""
+    msg = ""
+    if metadata.get('estimated_time'):
+        msg += format_time(metadata['estimated_time'], "预计耗时") + "\n"
+    if metadata.get('slicer'):
+        msg += f"切片软件: {metadata['slicer']} {metadata.get('slicer_version', '')}".rstrip() + "\n"
+    if metadata.get('layer_height'):
+        msg += f"层高: {metadata['layer_height']}mm\n"
+    if metadata.get('filament_total'):
+        msg += f"预计耗材: {metadata['filament_total'] / 1000:.2f}米\n"
+    return msg
+
+
+def calculatePrintTime2(status,printer=None):
+    estimated_time = (printer or default_printer).metadata_cache.get_for_status(status)['estimated_time']
+    total_time = estimated_time - status['print_stats']['print_duration']
     h = int(total_time // 3600)
     m = int((total_time % 3600) // 60)
     s = int(total_time % 60)
     return f"{h}h {m}m {s}s"
 
-def getPrintStatus():
-    response = requests.get(
-        f"http://{get_device_ip()}/printer/objects/query?print_stats&virtual_sdcard&toolhead&extruder&heater_bed&gcode_move&display_status"
-    )
-    printer_data = response.json()
-    print(printer_data)
-    state_map = {
-        'printing': '打印中',
-        'paused': '已暂停',
-        'complete': '已完成',
-        'cancelled': '已取消',
-        'error': '错误',
-        'ready': '待机',
-        'standby': '待机',
-        'unknown': '未知状态'
-    }
-
-    state = printer_data['result']['status']['print_stats']['state']
-    status_msg = f"------🖨️ 打印状态------\n"
-    status_msg += f"打印机状态: {state_map.get(state, state)}\n"
+STATE_MAP = {
+    'printing': '打印中',
+    'paused': '已暂停',
+    'complete': '已完成',
+    'cancelled': '已取消',
+    'error': '错误',
+    'ready': '待机',
+    'standby': '待机',
+    'unknown': '未知状态'
+}
+
+
+def getPrintStatus(printer=None):
+    printer = printer or default_printer
+    # websocket 订阅在线时直接使用内存中的状态
+    status = printer.state.snapshot() if printer.state.is_live() else get_printer_objects(printer=printer)
+    state = status['print_stats']['state']
+    status_msg = f"------🖨️ {printer.label}打印状态------\n"
+    status_msg += f"打印机状态: {STATE_MAP.get(state, state)}\n"
     if state == 'printing':
         # a = asyncio.run(getPrintStatusWs())
         # print(a)
-        status_msg = f"文件名: {printer_data['result']['status']['print_stats']['filename']}\n"
+        status_msg += f"文件名: {status['print_stats']['filename']}\n"
 
         # 已用时间计算
-        print_duration = printer_data['result']['status']['print_stats']['print_duration']
+        print_duration = status['print_stats']['print_duration']
         h, remainder = divmod(print_duration, 3600)
         m, s = divmod(remainder, 60)
         status_msg += f"已用时间: {int(h)}h {int(m)}m {int(s)}s\n"
 
         # 进度信息
-        progress = printer_data['result']['status']['virtual_sdcard']['progress']
+        progress = status['virtual_sdcard']['progress']
         status_msg += f"打印进度【切片】: {progress * 100:.1f}%\n"
-        status_msg += f"剩余时间【切片】: {calculatePrintTime2(printer_data['result']['status']['print_stats']['filename'],printer_data['result']['status']['print_stats']['print_duration'])}%\n"
+        status_msg += f"剩余时间【切片】: {calculatePrintTime2(status,printer)}%\n"
 
 
-        progress = printer_data['result']['status']['display_status']['progress']
+        progress = status['display_status']['progress']
         status_msg += f"打印进度【实际】: {progress * 100:.1f}%\n"
-        status_msg += f"剩余时间【实际】: {calculatePrintTime(printer_data['result']['status']['print_stats']['print_duration'],printer_data['result']['status']['display_status']['progress'])}\n"
+        status_msg += f"剩余时间【实际】: {calculatePrintTime(status['print_stats']['print_duration'],status['display_status']['progress'])}\n"
 
         # 层数信息
-        current_layer = printer_data['result']['status']['print_stats']['info']['current_layer']
-        total_layer = printer_data['result']['status']['print_stats']['info']['total_layer']
-        layer_progress = current_layer / total_layer
+        current_layer = status['print_stats']['info']['current_layer']
+        total_layer = status['print_stats']['info']['total_layer']
         status_msg += f"层进度: {current_layer}/{total_layer}\n"
 
 
         # 耗材使用
-        filament_used = printer_data['result']['status']['print_stats']['filament_used'] / 1000
+        filament_used = status['print_stats']['filament_used'] / 1000
         status_msg += f"已用耗材: {filament_used:.2f} m\n"
 
     return status_msg
 
 
-def getPrintJobList():
+def getPrintSummary(printer=None):
+    """一行打印状态摘要，用于汇总多台打印机"""
+    printer = printer or default_printer
     try:
-        response = requests.get(f"http://{get_device_ip()}/server/history/totals")
-        data = response.json()
+        status = printer.state.snapshot() if printer.state.is_live() else get_printer_objects(printer=printer)
+        print_stats = status['print_stats']
+        state = print_stats['state']
+        line = f"[{printer.id}] {STATE_MAP.get(state, state)}"
+        if state in ('printing', 'paused'):
+            progress = status.get('display_status', {}).get('progress') or status['virtual_sdcard']['progress']
+            line += f" {progress * 100:.1f}%"
+            line += f" 剩余 {calculatePrintTime(print_stats['print_duration'], progress)}"
+            line += f" {print_stats['filename']}"
+        return line
+    except Exception as e:
+        return f"[{printer.id}] ❌ 获取状态失败: {str(e)}"
+
+
+def getFleetStatus():
+    """并发查询所有打印机，汇总为一条消息"""
+    lines = [future.result() for future in [fleet_executor.submit(getPrintSummary, printer) for printer in printers]]
+    msg = f"------🖨️ 全部打印机状态------\n"
+    msg += "\n".join(lines) + "\n"
+    msg += f"\n状态更新时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    return msg
+
+
+def getPrintJobList(printer=None):
+    printer = printer or default_printer
+    try:
+        data = printer.client.get("/server/history/totals")
 
         if 'result' not in data or 'job_totals' not in data['result']:
             return "❌ 无法获取打印任务统计"
 
         totals = data['result']['job_totals']
-        msg = f"------🖨️ 打印任务统计------\n"
+        msg = f"------🖨️ {printer.label}打印任务统计------\n"
         msg += f"总任务次数: {int(totals['total_jobs'])}\n"
         msg += format_time(totals['total_time'], "总时间")
         msg += "\n" + format_time(totals['total_print_time'], "总打印时间") + "\n"
@@ -309,20 +1198,23 @@ def getPrintJobList():
 
 
 
-def getSystemStatus():
-    """获取系统利用率"""
+def _get_proc_stats(printer):
+    proc_stats = printer.state.proc_stats() if printer.state.is_live() else None
+    if not proc_stats:
+        proc_stats = printer.client.get("/machine/proc_stats")['result']
+    return proc_stats
+
 
+def getSystemStatus(printer=None):
+    """获取系统利用率"""
+    printer = printer or default_printer
     try:
         # 获取系统信息
-        res = requests.get(f"http://{get_device_ip()}/machine/proc_stats")
-        proc_stats = res.json()
-
-        res = requests.get(f"http://{get_device_ip()}/machine/system_info")
-        sys_info = res.json()
+        proc_stats, sys_info = run_parallel(lambda: _get_proc_stats(printer), printer.system_info_cache.get)
 
         # CPU使用率信息
-        cpu_usage = proc_stats['result']['system_cpu_usage']
-        msg =  f"------🖥️ 系统状态------\n"
+        cpu_usage = proc_stats['system_cpu_usage']
+        msg =  f"------🖥️ {printer.label}系统状态------\n"
         msg += f"CPU使用率: {cpu_usage['cpu']:.1f}%\n"
 
         core_usage = []
@@ -337,16 +1229,16 @@ def getSystemStatus():
             msg += "核心使用率: 无数据\n"
 
         # 内存信息
-        memory_used = proc_stats['result']['system_memory']['used']
-        memory_total = proc_stats['result']['system_memory']['total']
+        memory_used = proc_stats['system_memory']['used']
+        memory_total = proc_stats['system_memory']['total']
         memory_percent = (memory_used / memory_total) * 100
         msg += f"内存使用: {memory_used / 1024:.1f}MB/{memory_total / 1024:.1f}MB ({memory_percent:.1f}%)\n"
 
         # CPU温度
-        if 'cpu_temp' in proc_stats['result']:
-            msg += f"CPU温度: {proc_stats['result']['cpu_temp']:.1f}°C\n"
-        if 'network' in sys_info['result']['system_info']:
-            network = sys_info['result']['system_info']['network']
+        if 'cpu_temp' in proc_stats:
+            msg += f"CPU温度: {proc_stats['cpu_temp']:.1f}°C\n"
+        if 'network' in sys_info['system_info']:
+            network = sys_info['system_info']['network']
             for interface, info in network.items():
                 if interface.startswith('wlan') or interface.startswith('eth'):
                     msg += f"\n网络接口 {interface}:\n"
@@ -363,14 +1255,15 @@ def getSystemStatus():
         return f"❌ 获取系统状态失败: {str(e)}"
 
 
-def controlLight(action="on"):
+def controlLight(action="on", printer=None):
     try:
         action = action.lower()
         if action not in ['on', 'off', 'toggle', 'status']:
             return "❌ 无效操作，请使用 on/off/toggle/status"
         gcode_command = f"SET_PIN PIN=caselight VALUE={1 if action == 'on' else 0}"
-        requests.post( f"http://{get_device_ip()}/printer/gcode/script",json={"script": gcode_command}, )
-        return f"✅ 补光灯已{'开启' if action == 'on' else '关闭'}"
+        printer = printer or default_printer
+        printer.client.post("/printer/gcode/script", json={"script": gcode_command})
+        return f"✅ {printer.label}补光灯已{'开启' if action == 'on' else '关闭'}"
 
     except requests.exceptions.Timeout:
         return "❌ 请求超时，请检查Moonraker连接"
@@ -379,77 +1272,358 @@ def controlLight(action="on"):
 
 
 
-def sendWxMSg(user_id, text_content, image_base64=None):
-    """推送到企业微信"""
-    try:
-        access_token = getAccessToken()
-
-        if image_base64:
-            upload_url = f"https://qyapi.weixin.qq.com/cgi-bin/media/upload?access_token={access_token}&type=image"
-            image_data = base64.b64decode(image_base64)
-            files = {'media': ('print_snapshot.jpg', image_data, 'image/jpeg')}
-
-            upload_response = requests.post(upload_url, files=files)
-            upload_result = upload_response.json()
-
-            if upload_result.get('errcode') == 0:
-                media_id = upload_result.get('media_id')
-                data = {
-                    "touser": user_id,
-                    "msgtype": "image",
-                    "agentid": agent_id,
-                    "image": {
-                        "media_id": media_id
-                    }
-                }
-                send_url = f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={access_token}"
-                response = requests.post(send_url, json=data)
-                text_data = {
-                    "touser": user_id,
-                    "msgtype": "text",
-                    "agentid": agent_id,
-                    "text": {
-                        "content": text_content
-                    }
-                }
-                requests.post(send_url, json=text_data)
+# 临时素材有效期 3 天，提前 1 小时视为过期
+MEDIA_TTL = 3 * 24 * 3600 - 3600
+# media_id 无效的错误码
+MEDIA_INVALID_ERRCODE = 40007
+
+
+SELECT_MEDIA_SQL = 'SELECT media_id, expires_at FROM media_cache WHERE content_hash = ? AND expires_at > ?'
+SAVE_MEDIA_SQL = 'INSERT OR REPLACE INTO media_cache (content_hash, media_id, expires_at) VALUES (?, ?, ?)'
+DELETE_MEDIA_SQL = 'DELETE FROM media_cache WHERE content_hash = ?'
+
+
+class MediaCache:
+    """企业微信临时素材缓存
+
+    按图片内容的 sha256 缓存 media_id，同一张图片只上传一次，
+    后续发送直接复用；同时写入数据库，进程重启后仍可复用。
+    """
+
+    def __init__(self, ttl=MEDIA_TTL, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        self.hits = 0
+        self.uploads = 0
+
+    def _load(self, content_hash):
+        try:
+            return storage.fetchone(SELECT_MEDIA_SQL, (content_hash, int(time.time())))
+        except Error as e:
+            print(f"查询素材缓存错误: {e}")
+        return None
+
+    def _save(self, content_hash, media_id, expires_at):
+        try:
+            storage.execute(SAVE_MEDIA_SQL, (content_hash, media_id, expires_at))
+        except Error as e:
+            print(f"保存素材缓存错误: {e}")
+
+    def _remember(self, content_hash, media_id, expires_at):
+        with self._lock:
+            self._entries[content_hash] = (media_id, expires_at)
+            self._entries.move_to_end(content_hash)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, content_hash):
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(content_hash)
+                return entry[0]
+        row = self._load(content_hash)
+        if row:
+            self._remember(content_hash, row[0], row[1])
+            return row[0]
+        return None
 
+    def get_media_id(self, snapshot):
+        """返回图片的 media_id，未缓存时上传；上传失败返回 None"""
+        content_hash = hashlib.sha256(snapshot.data).hexdigest()
+        with self._lock:
+            # [锁, 使用者数]，最后一个使用者离开时才删除，保证同一张图片始终共用一把锁
+            entry = self._upload_locks.setdefault(content_hash, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            # 同一张图片同时发送给多人时只上传一次
+            with entry[0]:
+                media_id = self._lookup(content_hash)
+                if media_id:
+                    self.hits += 1
+                    return media_id
+                files = {'media': ('print_snapshot.jpg', snapshot.data, snapshot.content_type)}
+                upload_result = stage_timings.timed(
+                    'upload', wecom_request, 'POST', '/media/upload', params={'type': 'image'}, files=files
+                )
+                if upload_result.get('errcode') != 0:
+                    print(f"上传图片失败: {upload_result}")
+                    return None
+                self.uploads += 1
+                media_id = upload_result['media_id']
+                expires_at = int(upload_result.get('created_at', time.time())) + self.ttl
+                self._remember(content_hash, media_id, expires_at)
+                self._save(content_hash, media_id, expires_at)
+                return media_id
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._upload_locks[content_hash]
+
+    def invalidate(self, snapshot):
+        content_hash = hashlib.sha256(snapshot.data).hexdigest()
+        with self._lock:
+            self._entries.pop(content_hash, None)
+        try:
+            storage.execute(DELETE_MEDIA_SQL, (content_hash,))
+        except Error as e:
+            print(f"删除素材缓存错误: {e}")
+
+    def stats(self):
+        return {'cached': len(self._entries), 'hits': self.hits, 'uploads': self.uploads}
+
+
+media_cache = MediaCache()
+
+
+# 接口调用频率超限的错误码
+THROTTLED_ERRCODE = 45009
+# 文本消息内容上限（单位：字节）
+TEXT_LIMIT = 2048
+
+
+class TokenBucket:
+    """令牌桶限速，rate 为每秒令牌数，capacity 为突发上限"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，没有可用令牌时等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+send_limiter = TokenBucket(
+    rate=config.getint("wechat", "send_rate_per_minute", fallback=60) / 60,
+    capacity=config.getint("wechat", "send_burst", fallback=10),
+)
+
+
+def send_message(data, retries=3):
+    """发送应用消息，按令牌桶限速，频率超限（45009）时退避重试"""
+    delay = 1
+    for attempt in range(retries + 1):
+        send_limiter.acquire()
+        result = wecom_request('POST', '/message/send', json=data)
+        if result.get('errcode') != THROTTLED_ERRCODE or attempt == retries:
+            return result
+        print(f"发送消息频率超限，{delay}秒后重试")
+        message_queue.throttled += 1
+        time.sleep(delay)
+        delay *= 2
+    return result
+
+
+class MessageQueue:
+    """企业微信发送队列
+
+    消息在后台线程中按顺序发送，调用方不用等待网络请求；
+    队列中发给同一接收人的连续纯文本消息会合并为一条发送。
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+        self.throttled = 0
+        self._total_latency = 0.0
+        self._total_send_time = 0.0
+
+    def put(self, user_id, text_content, image=None):
+        with self._cond:
+            self._queue.append((time.time(), user_id, text_content, image))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="wecom-sender", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _next(self):
+        """取出下一条消息，并合并其后发给同一人的纯文本消息"""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            enqueued_at, user_id, text_content, image = self._queue.popleft()
+            if image is None:
+                while self._queue:
+                    _, next_user, next_text, next_image = self._queue[0]
+                    merged_text = text_content + "\n\n" + next_text
+                    if next_user != user_id or next_image is not None or len(merged_text.encode('utf-8')) > TEXT_LIMIT:
+                        break
+                    self._queue.popleft()
+                    text_content = merged_text
+                    self.merged += 1
+            return enqueued_at, user_id, text_content, image
+
+    def _worker(self):
+        while True:
+            enqueued_at, user_id, text_content, image = self._next()
+            started = time.time()
+            try:
+                ok = self.sender(user_id, text_content, image)
+            except Exception as e:
+                print(f"发送消息异常: {e}")
+                ok = False
+            finished = time.time()
+            if ok:
+                self.sent += 1
             else:
-                data = {
-                    "touser": user_id,
-                    "msgtype": "text",
-                    "agentid": agent_id,
-                    "text": {
-                        "content": text_content + "\n\n[图片上传失败]"
-                    }
-                }
-                send_url = f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={access_token}"
-                response = requests.post(send_url, json=data)
+                self.failed += 1
+            self._total_latency += finished - enqueued_at
+            self._total_send_time += finished - started
+
+    def stats(self):
+        done = self.sent + self.failed
+        return {
+            'depth': len(self._queue),
+            'sent': self.sent,
+            'failed': self.failed,
+            'merged': self.merged,
+            'throttled': self.throttled,
+            'avg_latency_ms': round(self._total_latency / done * 1000, 1) if done else 0,
+            'avg_send_ms': round(self._total_send_time / done * 1000, 1) if done else 0,
+        }
 
-        else:
-            data = {
-                "touser": user_id,
-                "msgtype": "text",
-                "agentid": agent_id,
-                "text": {
-                    "content": text_content
-                }
-            }
-            send_url = f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={access_token}"
-            response = requests.post(send_url, json=data)
-        result = response.json()
-        if result['errcode'] != 0:
-            print(f"发送消息失败: {result}")
-            return False
-        else:
-            return  True
 
-    except Exception as e:
-        print(f"发送消息异常: {str(e)}")
+def split_text(text_content, limit=TEXT_LIMIT):
+    """按行把超过长度上限的文本拆成多段"""
+    chunks = []
+    current = ""
+    for line in text_content.split("\n"):
+        candidate = f"{current}\n{line}" if current else line
+        if current and len(candidate.encode('utf-8')) > limit:
+            chunks.append(current)
+            candidate = line
+        while len(candidate.encode('utf-8')) > limit:
+            # 单行超长时按字节截断
+            cut = candidate.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+            chunks.append(cut)
+            candidate = candidate[len(cut):]
+        current = candidate
+    chunks.append(current)
+    return chunks
 
 
+def queueWxMsg(user_id, text_content, image=None):
+    """加入发送队列，由后台线程推送到企业微信；超长文本拆成多条"""
+    chunks = split_text(text_content) if text_content else [text_content]
+    for chunk in chunks[:-1]:
+        message_queue.put(user_id, chunk)
+    message_queue.put(user_id, chunks[-1], image)
 
 
+class DeliveryReport:
+    """一次推送的发送结果，记录每条消息的 errcode；全部成功时为真"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.results = []
+
+    def add(self, kind, result):
+        self.results.append({
+            'kind': kind,
+            'errcode': result.get('errcode', -1),
+            'errmsg': result.get('errmsg', ''),
+            'msgid': result.get('msgid'),
+        })
+
+    @property
+    def ok(self):
+        return bool(self.results) and all(r['errcode'] == 0 for r in self.results)
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return f"DeliveryReport(user_id={self.user_id!r}, results={self.results!r})"
+
+
+# 文字消息与图片上传并发发送
+send_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="send")
+
+
+def _text_message(user_id, text_content):
+    return {
+        "touser": user_id,
+        "msgtype": "text",
+        "agentid": agent_id,
+        "text": {
+            "content": text_content
+        }
+    }
+
+
+def _send_image(user_id, snapshot):
+    media_id = media_cache.get_media_id(snapshot)
+    if not media_id:
+        return {'errcode': -1, 'errmsg': '图片上传失败'}
+    data = {
+        "touser": user_id,
+        "msgtype": "image",
+        "agentid": agent_id,
+        "image": {
+            "media_id": media_id
+        }
+    }
+    result = send_message(data)
+    if result.get('errcode') == MEDIA_INVALID_ERRCODE:
+        # 缓存的 media_id 已失效，重新上传后再发一次
+        media_cache.invalidate(snapshot)
+        data['image']['media_id'] = media_cache.get_media_id(snapshot)
+        result = send_message(data)
+    return result
+
+
+def sendWxMSg(user_id, text_content, image=None):
+    """推送到企业微信，image 为 Snapshot（兼容 base64 字符串）
+
+    有图片时文字消息与图片上传同时进行，上传完成后立即发送图片；
+    图片发送失败时在文字之后补发提示。返回 DeliveryReport。
+    """
+    report = DeliveryReport(user_id)
+    try:
+        snapshot = as_snapshot(image)
+        text_future = None
+        if text_content or not snapshot:
+            text_future = send_executor.submit(send_message, _text_message(user_id, text_content))
+        image_failed = False
+        if snapshot:
+            image_result = _send_image(user_id, snapshot)
+            report.add('image', image_result)
+            image_failed = image_result.get('errcode') != 0
+        if text_future is not None:
+            report.add('text', text_future.result())
+        if image_failed:
+            report.add('notice', send_message(_text_message(user_id, "[图片发送失败]")))
+    except Exception as e:
+        print(f"发送消息异常: {str(e)}")
+        report.add('error', {'errcode': -1, 'errmsg': str(e)})
+    if not report:
+        print(f"发送消息失败: {report}")
+    return report
+
+
+message_queue = MessageQueue(sendWxMSg)
 
 
 def format_time(seconds, prefix):
@@ -469,25 +1643,111 @@ def format_time(seconds, prefix):
 
 
 
+class PollScheduler:
+    """轮询间隔调度
+
+    待机时按 idle_interval 轮询，打印中按 check_interval 轮询，预计临近完成时快速轮询；
+    连续获取失败时以最近一次成功的间隔为基数按指数退避。
+    """
+
+    IDLE_STATES = ('standby', 'ready', 'complete', 'cancelled', 'error', 'unknown')
+
+    def __init__(self, printing_interval, idle_interval=None, fast_interval=2, fast_window=120, max_backoff=300):
+        self.printing_interval = printing_interval
+        # 默认与打印中相同，避免延迟发现新开始的打印
+        self.idle_interval = printing_interval if idle_interval is None else idle_interval
+        self.fast_interval = fast_interval
+        self.fast_window = fast_window
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_interval = printing_interval
+
+    def record_failure(self):
+        self.failures += 1
+
+    def record_success(self):
+        self.failures = 0
+
+    @staticmethod
+    def remaining_time(status, metadata=None):
+        """预计剩余时间（单位：秒），无法估算时返回 None"""
+        print_stats = status['print_stats']
+        print_duration = print_stats.get('print_duration', 0)
+        if metadata and metadata.get('estimated_time'):
+            return metadata['estimated_time'] - print_duration
+        progress = (status.get('display_status') or {}).get('progress') or \
+            (status.get('virtual_sdcard') or {}).get('progress') or 0
+        if progress > 0:
+            return print_duration / progress - print_duration
+        return None
+
+    def next_interval(self, status=None, metadata=None):
+        """根据最近一次状态计算下次轮询的间隔"""
+        if self.failures:
+            return min(self.last_interval * 2 ** self.failures, self.max_backoff)
+        self.last_interval = self._interval(status, metadata)
+        return self.last_interval
+
+    def _interval(self, status, metadata):
+        if not status:
+            return self.printing_interval
+        state = status['print_stats']['state']
+        if state in self.IDLE_STATES:
+            return self.idle_interval
+        if state != 'printing':
+            return self.printing_interval
+        remaining = self.remaining_time(status, metadata)
+        if remaining is None:
+            return self.printing_interval
+        if remaining <= self.fast_window:
+            return self.fast_interval
+        # 不要睡过快速轮询窗口的起点
+        return max(self.fast_interval, min(self.printing_interval, remaining - self.fast_window))
+
+
 class PrinterMonitor:
-    def __init__(self):
+    def __init__(self, printer=None):
+        self.printer = printer or default_printer
         self.last_state = None
         self.current_print_info = None
         self.check_interval = int(check_interval)
+        self.use_websocket = config.getboolean('monitor', 'use_websocket', fallback=True)
+        self.scheduler = PollScheduler(
+            self.check_interval,
+            idle_interval=config.getint('monitor', 'idle_interval', fallback=self.check_interval),
+            fast_interval=config.getint('monitor', 'fast_interval', fallback=2),
+            fast_window=config.getint('monitor', 'fast_window', fallback=120),
+            max_backoff=config.getint('monitor', 'max_backoff', fallback=300),
+        )
+        self._executor = ThreadPoolExecutor(max_workers=1)
 
     def get_printer_status(self):
         """获取打印机状态"""
         try:
-            response = requests.get(
-                f"http://{get_device_ip()}/printer/objects/query?"
-                f"print_stats&virtual_sdcard"
-            )
-            printer_data = response.json()
-            return printer_data['result']['status']
+            return get_printer_objects(printer=self.printer)
+        except Exception as e:
+            print(f"{self.printer.label}获取打印机状态失败: {e}")
+            return None
+
+    def get_metadata(self, status):
+        """获取状态中当前文件的切片信息，失败时返回 None"""
+        try:
+            return self.printer.metadata_cache.get_for_status(status)
         except Exception as e:
-            print(f"获取打印机状态失败: {e}")
+            print(f"获取文件元数据失败: {e}")
             return None
 
+    def next_poll_interval(self, current_status):
+        """记录本次轮询结果并计算下次轮询间隔"""
+        if not current_status:
+            self.scheduler.record_failure()
+            return self.scheduler.next_interval()
+        self.scheduler.record_success()
+        metadata = None
+        if current_status['print_stats']['state'] == 'printing':
+            metadata = self.get_metadata(current_status)
+        return self.scheduler.next_interval(current_status, metadata)
+
     def check_state_change(self, current_status):
         """检查状态变化"""
         current_state = current_status['print_stats']['state']
@@ -510,13 +1770,19 @@ class PrinterMonitor:
         print_stats = status['print_stats']
         filename = print_stats.get('filename', '未知文件')
 
-        message = "🟢 打印任务开始\n\n"
+        message = f"🟢 {self.printer.label}打印任务开始\n\n"
         message += f"文件名: {filename}\n"
         message += f"开始时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        metadata = self.get_metadata(status)
+        if metadata:
+            message += format_gcode_info(metadata)
+            if metadata.get('estimated_time'):
+                eta = datetime.now() + timedelta(seconds=metadata['estimated_time'])
+                message += f"预计完成: {eta.strftime('%Y-%m-%d %H:%M:%S')}\n"
 
         # 获取图片并发送
         # image_base64 = get_current_print_image()
-        sendWxMSg("@all", message)
+        queueWxMsg("@all", message)
 
         # 保存当前打印信息
         self.current_print_info = {
@@ -536,14 +1802,17 @@ class PrinterMonitor:
         hours, remainder = divmod(print_duration, 3600)
         minutes, seconds = divmod(remainder, 60)
 
-        message = "✅ 打印任务完成\n\n"
+        message = f"✅ {self.printer.label}打印任务完成\n\n"
         message += f"文件名: {filename}\n"
         message += f"打印耗时: {int(hours)}h {int(minutes)}m {int(seconds)}s\n"
         message += f"耗材使用量: {filament_used / 1000:.2f}米\n"
         message += f"完成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        metadata = self.get_metadata(status)
+        if metadata:
+            message += format_gcode_info(metadata)
 
         # 获取完成时的图片
-        sendWxMSg("@all", message, get_current_print_image())
+        queueWxMsg("@all", message, get_current_print_image(printer=self.printer))
         # 清空当前打印信息
         self.current_print_info = None
 
@@ -557,12 +1826,12 @@ class PrinterMonitor:
         hours, remainder = divmod(print_duration, 3600)
         minutes, seconds = divmod(remainder, 60)
 
-        message = "⏹️ 打印任务取消\n\n"
+        message = f"⏹️ {self.printer.label}打印任务取消\n\n"
         message += f"文件名: {filename}\n"
         message += f"已打印: {int(hours)}h {int(minutes)}m {int(seconds)}s\n"
         message += f"耗材使用量: {filament_used / 1000:.2f}米\n"
         message += f"取消时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        sendWxMSg("@all", message)
+        queueWxMsg("@all", message)
         self.current_print_info = None
 
     def handle_print_error(self, status):
@@ -571,11 +1840,11 @@ class PrinterMonitor:
         filename = print_stats.get('filename', '未知文件')
         error_message = print_stats.get('message', '未知错误')
 
-        message = "❌ 打印任务错误\n\n"
+        message = f"❌ {self.printer.label}打印任务错误\n\n"
         message += f"文件名: {filename}\n"
         message += f"错误信息: {error_message}\n"
         message += f"错误时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        sendWxMSg("@all", message, get_current_print_image())
+        queueWxMsg("@all", message, get_current_print_image(printer=self.printer))
         self.current_print_info = None
 
     def monitor_loop(self):
@@ -587,31 +1856,104 @@ class PrinterMonitor:
                 # 获取当前状态
                 current_status = self.get_printer_status()
                 if not current_status:
-                    time.sleep(self.check_interval)
+                    time.sleep(self.next_poll_interval(None))
                     continue
 
                 # 检查状态变化
                 state_changed, old_state, new_state = self.check_state_change(current_status)
 
                 if state_changed:
-                    print(f"状态变化: {old_state} -> {new_state}")
+                    print(f"{self.printer.label}状态变化: {old_state} -> {new_state}")
+                    handler = self.get_state_handler(old_state, new_state)
+                    if handler:
+                        handler(current_status)
+
+                # 按打印状态调整休眠时间
+                time.sleep(self.next_poll_interval(current_status))
+
+            except Exception as e:
+                print(f"监控循环错误: {e}")
+                time.sleep(self.check_interval)
+
+    def get_state_handler(self, old_state, new_state):
+        """根据状态变化选择处理函数"""
+        if new_state == 'printing' and old_state != 'printing':
+            return self.handle_print_start
+        if old_state == 'printing':
+            return {
+                'complete': self.handle_print_complete,
+                'cancelled': self.handle_print_cancelled,
+                'error': self.handle_print_error,
+            }.get(new_state)
+        return None
+
+    def on_status_update(self, state):
+        """websocket 状态更新回调，在事件循环线程中执行"""
+        if not state.is_live() or state.print_stats['state'] == self.last_state:
+            return
+        self.process_status(state.snapshot())
+
+    def process_status(self, status):
+        """检查状态变化，处理函数放到单独线程中按顺序执行，不阻塞事件循环"""
+        state_changed, old_state, new_state = self.check_state_change(status)
+        if not state_changed:
+            return
+        print(f"{self.printer.label}状态变化: {old_state} -> {new_state}")
+        handler = self.get_state_handler(old_state, new_state)
+        if handler:
+            self._executor.submit(self._run_handler, handler, status)
+
+    def _run_handler(self, handler, status):
+        try:
+            handler(status)
+        except Exception as e:
+            print(f"处理状态变化失败: {e}")
+
+    async def websocket_loop(self):
+        """通过 websocket 订阅监控打印机状态"""
+        print(f"🚀 {self.printer.label}打印机监控服务启动（websocket）...")
+        subscriber = MoonrakerSubscriber(self.printer)
+        subscriber.add_listener(self.on_status_update)
+        await subscriber.run()
+
+    async def poll_loop(self):
+        """在事件循环中轮询打印机状态，HTTP 请求在线程中执行"""
+        print(f"🚀 {self.printer.label}打印机监控服务启动（轮询）...")
+        while True:
+            current_status = await asyncio.to_thread(self.get_printer_status)
+            interval = self.check_interval
+            try:
+                if current_status:
+                    self.process_status(current_status)
+                interval = await asyncio.to_thread(self.next_poll_interval, current_status)
+            except Exception as e:
+                print(f"{self.printer.label}监控循环错误: {e}")
+            await asyncio.sleep(interval)
 
-                    # 处理不同状态变化
-                    if new_state == 'printing' and old_state != 'printing':
-                        self.handle_print_start(current_status)
+    def run(self):
+        """启动监控，优先使用 websocket 订阅，未开启时使用轮询"""
+        if self.use_websocket:
+            asyncio.run(self.websocket_loop())
+        else:
+            self.monitor_loop()
 
-                    elif new_state == 'complete' and old_state == 'printing':
-                        self.handle_print_complete(current_status)
 
-                    elif new_state == 'cancelled' and old_state == 'printing':
-                        self.handle_print_cancelled(current_status)
+class FleetMonitor:
+    """多台打印机监控
 
-                    elif new_state == 'error' and old_state == 'printing':
-                        self.handle_print_error(current_status)
+    所有打印机共用一个事件循环和一个进程（token、数据库连接、发送队列都只有一份），
+    每台打印机有独立的 PrinterMonitor 保存各自的状态。
+    """
 
-                # 休眠一段时间
-                time.sleep(self.check_interval)
+    def __init__(self, printer_list=None):
+        self.monitors = [PrinterMonitor(printer) for printer in (printer_list or printers)]
 
-            except Exception as e:
-                print(f"监控循环错误: {e}")
-                time.sleep(self.check_interval)
\ No newline at end of file
+    async def run_async(self):
+        tasks = []
+        for monitor in self.monitors:
+            tasks.append(monitor.websocket_loop() if monitor.use_websocket else monitor.poll_loop())
+        await asyncio.gather(*tasks)
+
+    def run(self):
+        print(f"🚀 共监控 {len(self.monitors)} 台打印机")
+        asyncio.run(self.run_async())
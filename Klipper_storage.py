@@ -0,0 +1,192 @@
+import os
+import time
+import sqlite3
+import threading
+import configparser
+
+# 所有路径都相对于仓库根目录，与启动时的工作目录无关
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+config = configparser.ConfigParser()
+config.read(os.path.join(ROOT_DIR, 'config.conf'), encoding='utf-8')
+DB_FILE = os.path.join(ROOT_DIR, config.get('database', 'db_file', fallback='access_token.db'))
+
+# 旧版本每次刷新都插入一行的 token 表：wecom 为企业微信 access_token，qidi 为 QIDI 云端登录 token
+LEGACY_TOKEN_TABLES = {'wecom': 'token_cache', 'qidi': 'qidi_token_cache'}
+
+# 每种 token 的作用域，同一 kind/scope 只保留一行
+TOKEN_SCOPES = {
+    'wecom': f"{config.get('wechat', 'corp_id', fallback='')}:{config.get('wechat', 'agent_id', fallback='')}",
+    'qidi': config.get('made', 'username', fallback=''),
+}
+
+SELECT_TOKEN_SQL = 'SELECT token, expires_at FROM tokens WHERE kind = ? AND scope = ?'
+UPSERT_TOKEN_SQL = '''
+    INSERT INTO tokens (kind, scope, token, expires_at, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (kind, scope) DO UPDATE SET
+        token = excluded.token, expires_at = excluded.expires_at, updated_at = excluded.updated_at
+'''
+PRUNE_SQL = [
+    'DELETE FROM tokens WHERE expires_at <= ?',
+    'DELETE FROM media_cache WHERE expires_at <= ?',
+]
+
+
+def _compact_token_tables(conn):
+    """把旧 token 表中每种 token 最近的一行迁入 tokens 表，然后删除旧表"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tokens (
+            kind TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            token TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (kind, scope)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at)')
+    for kind, table in LEGACY_TOKEN_TABLES.items():
+        row = conn.execute(f'SELECT token, expires_at FROM {table} ORDER BY id DESC LIMIT 1').fetchone()
+        if row:
+            conn.execute(UPSERT_TOKEN_SQL, (kind, TOKEN_SCOPES[kind], row[0], row[1], int(time.time())))
+        conn.execute(f'DROP TABLE {table}')
+
+
+# 数据库结构版本，按顺序执行，当前版本记录在 PRAGMA user_version 中；
+# 每个版本是一组 SQL，或接收连接的迁移函数
+MIGRATIONS = [
+    # 1: 合并 Klipper_server、made/qidi、素材缓存与回调去重的表
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS token_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS qidi_token_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            content_hash TEXT PRIMARY KEY,
+            media_id TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS callback_dedup (
+            msg_key TEXT PRIMARY KEY,
+            seen_at INTEGER NOT NULL
+        )
+        ''',
+    ],
+    # 2: token 改为按 kind/scope 覆盖写入的单行记录，压缩旧表中的历史
+    _compact_token_tables,
+]
+
+
+class Storage:
+    """SQLite 持久化
+
+    每个进程只保留一个长连接，所有线程通过锁串行访问；
+    SQL 都是常量字符串，sqlite3 会按语句缓存预编译结果。
+    开启 WAL 后 Klipper_app 与 Klipper_monitor 两个进程可以同时读写。
+    """
+
+    def __init__(self, path=DB_FILE, timeout=10, prune_interval=3600):
+        self.path = path
+        self.timeout = timeout
+        self.prune_interval = prune_interval
+        self._conn = None
+        self._lock = threading.RLock()
+        self._pruned_at = 0
+        self.queries = 0
+
+    def connect(self):
+        """打开连接并执行未完成的迁移，重复调用直接返回已有连接"""
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                try:
+                    self._migrate(conn)
+                except sqlite3.Error:
+                    conn.close()
+                    raise
+                self._conn = conn
+            return self._conn
+
+    def _migrate(self, conn):
+        # 两个进程可能同时启动，在写事务中再读一次版本号
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for statement in migration:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+                print(f"数据库已迁移到版本 {number}")
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def execute(self, sql, params=()):
+        """执行写语句，返回受影响的行数"""
+        with self._lock:
+            conn = self.connect()
+            self.queries += 1
+            rowcount = conn.execute(sql, params).rowcount
+            self._maybe_prune(conn)
+            return rowcount
+
+    def fetchone(self, sql, params=()):
+        with self._lock:
+            conn = self.connect()
+            self.queries += 1
+            return conn.execute(sql, params).fetchone()
+
+    def _maybe_prune(self, conn):
+        """定期清理过期的 token 与素材缓存，需持有锁调用"""
+        now = time.monotonic()
+        if now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        expired_before = int(time.time())
+        for sql in PRUNE_SQL:
+            conn.execute(sql, (expired_before,))
+
+    def get_cached_token(self, kind, scope=None):
+        """获取保存的 token，返回 {'token', 'expires_at'}，没有时返回 None；scope 默认取配置"""
+        scope = TOKEN_SCOPES[kind] if scope is None else scope
+        row = self.fetchone(SELECT_TOKEN_SQL, (kind, scope))
+        if row:
+            return {'token': row[0], 'expires_at': row[1]}
+        return None
+
+    def save_token(self, kind, token, expires_at, scope=None):
+        scope = TOKEN_SCOPES[kind] if scope is None else scope
+        self.execute(UPSERT_TOKEN_SQL, (kind, scope, token, expires_at, int(time.time())))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self):
+        return {'path': self.path, 'queries': self.queries}
+
+
+storage = Storage(prune_interval=config.getint('database', 'prune_interval', fallback=3600))
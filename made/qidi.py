@@ -1,92 +1,38 @@
 import requests
-import sqlite3
+from sqlite3 import Error
 import configparser
 import time
 import jwt
 import os
+from Klipper_storage import storage
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 root_dir = os.path.dirname(current_dir)
 config_path = os.path.join(root_dir, 'config.conf')
 config = configparser.ConfigParser()
 config.read(config_path, encoding='utf-8')
-DB_FILE = 'qidi_token.db'
 username = config.get('made', 'username')
 password = config.get('made', 'password')
 ip = config.get('made', 'ip')
 
 
-def create_connection():
-    conn = None
+def save_token_to_db(token):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        return conn
+        # 解析token获取过期时间
+        decoded_token = jwt.decode(token, options={"verify_signature": False})
+        expires_at = decoded_token.get('exp', 0)
+        storage.save_token('qidi', token, expires_at)
+        print(f"Token已保存，过期时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}")
     except Exception as e:
-        print(f"数据库连接错误: {e}")
-    return conn
-
-
-def init_db():
-    """初始化数据库表"""
-    conn = create_connection()
-    if conn is not None:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                 CREATE TABLE IF NOT EXISTS qidi_token_cache (
-                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     token TEXT NOT NULL,
-                     expires_at INTEGER NOT NULL,
-                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                 )
-             ''')
-            conn.commit()
-        except Exception as e:
-            print(f"初始化数据库错误: {e}")
-        finally:
-            conn.close()
-
-
-def save_token_to_db(token):
-    conn = create_connection()
-    if conn is not None:
-        try:
-            # 解析token获取过期时间
-            decoded_token = jwt.decode(token, options={"verify_signature": False})
-            expires_at = decoded_token.get('exp', 0)
-            print(expires_at)
-
-            current_time = int(time.time())
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO qidi_token_cache (token, expires_at)
-                VALUES (?, ?)
-            ''', (token, expires_at))
-            conn.commit()
-            print(f"Token已保存，过期时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}")
-        except Exception as e:
-            print(f"保存token到数据库错误: {e}")
-        finally:
-            conn.close()
+        print(f"保存token到数据库错误: {e}")
 
 
 def get_cached_token():
     """从数据库获取缓存的token"""
-    conn = create_connection()
-    if conn is not None:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT token, expires_at FROM qidi_token_cache 
-                ORDER BY created_at DESC LIMIT 1
-            ''')
-            row = cursor.fetchone()
-            if row:
-                return {'token': row[0], 'expires_at': row[1]}
-        except Exception as e:
-            print(f"查询缓存token错误: {e}")
-        finally:
-            conn.close()
+    try:
+        return storage.get_cached_token('qidi')
+    except Error as e:
+        print(f"查询缓存token错误: {e}")
     return None
 
 
@@ -145,7 +91,6 @@ def login():
 
 
 def get_token():
-    init_db()
     cached_token = get_cached_token()
     if is_token_valid(cached_token):
         return cached_token['token']
@@ -157,7 +102,9 @@ def get_token():
         return None
 
 
-def get_device_url():
+def get_device_url(local_ip=None):
+    """根据局域网 IP 查找设备的远程地址，local_ip 默认为配置中的 ip"""
+    local_ip = local_ip or ip
     token = get_token()
     if not token:
         return None
@@ -169,7 +116,7 @@ def get_device_url():
     response = requests.get(url, headers=headers, timeout=10).json()
     if response['status'] == 0:
         for x in response['data']['list']:
-            if x['local_ip'] == ip:
+            if x['local_ip'] == local_ip:
                 device_url = x['url']
                 return device_url
     return None
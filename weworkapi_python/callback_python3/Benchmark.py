@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#########################################################################
+# File Name: Benchmark.py
+# Description: 回调解密性能对比：每次构造辅助对象的旧流程 vs 复用对象的 DecryptMsg / DecryptMsgFast
+# Usage: python Benchmark.py [次数]
+#########################################################################
+import base64
+import os
+import sys
+import time
+
+from WXBizMsgCrypt import WXBizMsgCrypt, XMLParse, SHA1, Prpcrypt
+import ierror
+
+# 企业微信文本消息回调的典型明文
+SAMPLE_MSG = """<xml><ToUserName><![CDATA[ww1436e0e65a779aee]]></ToUserName>
+<FromUserName><![CDATA[ZhangSan]]></FromUserName>
+<CreateTime>1348831860</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[打印状态]]></Content>
+<MsgId>1234567890123456</MsgId>
+<AgentID>1000002</AgentID>
+</xml>"""
+
+POST_TEMPLATE = """<xml><ToUserName><![CDATA[ww1436e0e65a779aee]]></ToUserName>
+<Encrypt><![CDATA[%s]]></Encrypt>
+<AgentID><![CDATA[1000002]]></AgentID>
+</xml>"""
+
+
+def legacy_decrypt(wxcpt, sPostData, sMsgSignature, sTimeStamp, sNonce):
+    """优化前的 DecryptMsg：每次调用都重新构造 XMLParse、SHA1 和 Prpcrypt"""
+    ret, encrypt = XMLParse().extract(sPostData)
+    if ret != 0:
+        return ret, None
+    ret, signature = SHA1().getSHA1(wxcpt.m_sToken, sTimeStamp, sNonce, encrypt)
+    if ret != 0:
+        return ret, None
+    if not signature == sMsgSignature:
+        return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
+    return Prpcrypt(wxcpt.key).decrypt(encrypt, wxcpt.m_sReceiveId)
+
+
+def run(name, func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        ret, _ = func()
+        assert ret == 0
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} {count / elapsed:>10.0f} 次/秒  {elapsed / count * 1e6:>8.1f} 微秒/次")
+    return elapsed
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sToken = "QDG6eK"
+    sEncodingAESKey = base64.b64encode(os.urandom(32)).decode()[:-1]
+    sCorpID = "ww1436e0e65a779aee"
+    sTimeStamp = "1409659813"
+    sNonce = "1372623149"
+
+    wxcpt = WXBizMsgCrypt(sToken, sEncodingAESKey, sCorpID)
+    ret, encrypt = wxcpt.pc.encrypt(SAMPLE_MSG, sCorpID)
+    encrypt = encrypt.decode()
+    _, sMsgSignature = wxcpt.sha1.getSHA1(sToken, sTimeStamp, sNonce, encrypt)
+    sPostData = POST_TEMPLATE % encrypt
+    sPostBytes = sPostData.encode()
+
+    assert wxcpt.DecryptMsgFast(sPostBytes, sMsgSignature, sTimeStamp, sNonce) == \
+        wxcpt.DecryptMsg(sPostData, sMsgSignature, sTimeStamp, sNonce)
+
+    base = run("legacy", lambda: legacy_decrypt(wxcpt, sPostData, sMsgSignature, sTimeStamp, sNonce), count)
+    cached = run("DecryptMsg", lambda: wxcpt.DecryptMsg(sPostData, sMsgSignature, sTimeStamp, sNonce), count)
+    fast = run("DecryptMsgFast", lambda: wxcpt.DecryptMsgFast(sPostBytes, sMsgSignature, sTimeStamp, sNonce), count)
+    print(f"DecryptMsg 提升 {base / cached:.2f}x，DecryptMsgFast 提升 {base / fast:.2f}x")
@@ -10,6 +10,7 @@ import logging
 import base64
 import random
 import hashlib
+import hmac
 import time
 import struct
 from Crypto.Cipher import AES
@@ -140,6 +141,9 @@ class Prpcrypt(object):
         self.key = key
         # 设置加解密模式为AES的CBC模式
         self.mode = AES.MODE_CBC
+        # CBC 模式的 cipher 对象带有链式状态，不能跨消息复用，这里只预先计算 IV
+        self.iv = key[:16]
+        self.pkcs7 = PKCS7Encoder()
 
     def encrypt(self, text, receiveid):
         """对明文进行加密
@@ -151,10 +155,9 @@ class Prpcrypt(object):
         text = self.get_random_str() + struct.pack("I", socket.htonl(len(text))) + text + receiveid.encode()
 
         # 使用自定义的填充方式对明文进行补位填充
-        pkcs7 = PKCS7Encoder()
-        text = pkcs7.encode(text)
+        text = self.pkcs7.encode(text)
         # 加密
-        cryptor = AES.new(self.key, self.mode, self.key[:16])
+        cryptor = AES.new(self.key, self.mode, self.iv)
         try:
             ciphertext = cryptor.encrypt(text)
             # 使用BASE64对加密后的字符串进行编码
@@ -170,7 +173,7 @@ class Prpcrypt(object):
         @return: 删除填充补位后的明文
         """
         try:
-            cryptor = AES.new(self.key, self.mode, self.key[:16])
+            cryptor = AES.new(self.key, self.mode, self.iv)
             # 使用BASE64对密文进行解码，然后AES-CBC解密
             plain_text = cryptor.decrypt(base64.b64decode(text))
         except Exception as e:
@@ -196,6 +199,27 @@ class Prpcrypt(object):
             return ierror.WXBizMsgCrypt_ValidateCorpid_Error, None
         return 0, xml_content
 
+    def decrypt_bytes(self, encrypt, receiveid):
+        """解密 bytes 密文，receiveid 为 bytes，直接在 bytes 上完成校验"""
+        try:
+            plain_text = AES.new(self.key, self.mode, self.iv).decrypt(base64.b64decode(encrypt))
+        except Exception as e:
+            logger = logging.getLogger()
+            logger.error(e)
+            return ierror.WXBizMsgCrypt_DecryptAES_Error, None
+        try:
+            pad = plain_text[-1]
+            xml_len = struct.unpack(">I", plain_text[16:20])[0]
+            xml_end = 20 + xml_len
+            from_receiveid = plain_text[xml_end:len(plain_text) - pad]
+        except Exception as e:
+            logger = logging.getLogger()
+            logger.error(e)
+            return ierror.WXBizMsgCrypt_IllegalBuffer, None
+        if from_receiveid != receiveid:
+            return ierror.WXBizMsgCrypt_ValidateCorpid_Error, None
+        return 0, plain_text[20:xml_end]
+
     def get_random_str(self):
         """ 随机生成16位字符串
         @return: 16位字符串
@@ -214,6 +238,12 @@ class WXBizMsgCrypt(object):
             # return ierror.WXBizMsgCrypt_IllegalAesKey,None
         self.m_sToken = sToken
         self.m_sReceiveId = sReceiveId
+        # 预先创建可复用的辅助对象，避免每次回调重复构造
+        self.m_bToken = sToken.encode()
+        self.m_bReceiveId = sReceiveId.encode()
+        self.pc = Prpcrypt(self.key)
+        self.sha1 = SHA1()
+        self.xmlParse = XMLParse()
 
         # 验证URL
         # @param sMsgSignature: 签名串，对应URL参数的msg_signature
@@ -224,14 +254,12 @@ class WXBizMsgCrypt(object):
         # @return：成功0，失败返回对应的错误码
 
     def VerifyURL(self, sMsgSignature, sTimeStamp, sNonce, sEchoStr):
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, sReplyEchoStr = pc.decrypt(sEchoStr, self.m_sReceiveId)
+        ret, sReplyEchoStr = self.pc.decrypt(sEchoStr, self.m_sReceiveId)
         return ret, sReplyEchoStr
 
     def EncryptMsg(self, sReplyMsg, sNonce, timestamp=None):
@@ -241,20 +269,17 @@ class WXBizMsgCrypt(object):
         # @param sNonce: 随机串，可以自己生成，也可以用URL参数的nonce
         # sEncryptMsg: 加密后的可以直接回复用户的密文，包括msg_signature, timestamp, nonce, encrypt的xml格式的字符串,
         # return：成功0，sEncryptMsg,失败返回对应的错误码None
-        pc = Prpcrypt(self.key)
-        ret, encrypt = pc.encrypt(sReplyMsg, self.m_sReceiveId)
+        ret, encrypt = self.pc.encrypt(sReplyMsg, self.m_sReceiveId)
         encrypt = encrypt.decode('utf8')
         if ret != 0:
             return ret, None
         if timestamp is None:
             timestamp = str(int(time.time()))
         # 生成安全签名
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
-        xmlParse = XMLParse()
-        return ret, xmlParse.generate(encrypt, signature, timestamp, sNonce)
+        return ret, self.xmlParse.generate(encrypt, signature, timestamp, sNonce)
 
     def DecryptMsg(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
         # 检验消息的真实性，并且获取解密后的明文
@@ -265,16 +290,42 @@ class WXBizMsgCrypt(object):
         #  xml_content: 解密后的原文，当return返回0时有效
         # @return: 成功0，失败返回对应的错误码
         # 验证安全签名
-        xmlParse = XMLParse()
-        ret, encrypt = xmlParse.extract(sPostData)
+        ret, encrypt = self.xmlParse.extract(sPostData)
         if ret != 0:
             return ret, None
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, xml_content = pc.decrypt(encrypt, self.m_sReceiveId)
+        ret, xml_content = self.pc.decrypt(encrypt, self.m_sReceiveId)
         return ret, xml_content
+
+    def DecryptMsgFast(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
+        # DecryptMsg 的快速版本，直接处理 bytes 格式的 POST 数据
+        # 从 bytes 中截取 Encrypt 节点，校验签名后解密，不构建 XML 树也不做 str/bytes 往返转换
+        # @param sPostData: 密文，对应POST请求的数据（bytes 或 str）
+        # @return: 成功0和解密后的原文（bytes），失败返回对应的错误码
+        if isinstance(sPostData, str):
+            sPostData = sPostData.encode()
+        start = sPostData.find(b"<Encrypt><![CDATA[")
+        end = sPostData.find(b"]]></Encrypt>", start)
+        if start == -1 or end == -1:
+            # 非常规格式时退回到 XML 解析
+            ret, encrypt = self.xmlParse.extract(sPostData)
+            if ret != 0:
+                return ret, None
+            encrypt = encrypt.encode()
+        else:
+            encrypt = sPostData[start + 18:end]
+        try:
+            sortlist = [self.m_bToken, sTimeStamp.encode(), sNonce.encode(), encrypt]
+            sortlist.sort()
+            signature = hashlib.sha1(b"".join(sortlist)).hexdigest()
+        except Exception as e:
+            logger = logging.getLogger()
+            logger.error(e)
+            return ierror.WXBizMsgCrypt_ComputeSignature_Error, None
+        if not hmac.compare_digest(signature.encode(), sMsgSignature.encode()):
+            return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
+        return self.pc.decrypt_bytes(encrypt, self.m_bReceiveId)